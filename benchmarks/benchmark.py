@@ -0,0 +1,257 @@
+# Benchmark suite for the diffraction engine.
+#
+# Times the pieces of the simulation that matter for throughput: propagation, mask
+# evaluation for each element type, saving results, netlist parsing, and complete runs
+# of main.py, across a range of grid sizes and dtypes. The results are written out as
+# JSON along with some information about the machine, and can be compared against a
+# previous results file (a baseline) to catch performance regressions.
+#
+# Usage, from the top-level directory:
+#   $ python3 -m benchmarks.benchmark --output results.json
+#   $ python3 -m benchmarks.benchmark --baseline results.json --tolerance 0.2
+# The second command exits with a non-zero status if anything got more than 20% slower.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)));
+sys.path.insert(0, REPOSITORY);
+
+from core.fields import Field, gridCoordinates
+from core.fourier import HAS_SCIPY_FFT, FFT_WORKERS
+from core.result_store import ResultStore
+from core.transfer_functions import transfer_function_cache
+from netlist.netlist_parser import NetlistParser
+
+DEFAULT_SIZES = [128, 256, 512, 1024, 2048, 4096];
+DEFAULT_DTYPES = ['complex128', 'complex64'];
+MAX_TEXT_SIZE = 1024; # np.savetxt takes minutes at larger sizes
+MEASURED_KEYS = ('min', 'median', 'points_per_second', 'bytes', 'baseline_ratio'); # Not part of a benchmark's identity
+
+# One line of each type of element the parser supports, used for the mask benchmarks.
+ELEMENT_LINES = {
+    'W': 'W1 0mm 500nm',
+    'G': 'G1 0mm 500nm 2mm',
+    'L': 'L1 10mm 100mm',
+    'C': 'C1 10mm 4mm',
+    'R': 'R1 10mm 4mm 2mm',
+    'S': 'S1 10mm 4mm',
+};
+
+def machineInfo():
+    return {
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy_fft': HAS_SCIPY_FFT,
+        'fft_workers': FFT_WORKERS,
+    };
+
+def timeit(function, repeat):
+    """
+    Runs function repeat times (after one warm-up run, unless repeat is 1), and returns the
+    minimum and median wall time in seconds. Anything printed by function is discarded.
+    """
+    times = [];
+    with contextlib.redirect_stdout(io.StringIO()):
+        if(repeat > 1):
+            function();
+        for i in range(repeat):
+            start = time.perf_counter();
+            function();
+            times.append(time.perf_counter() - start);
+    return {'min': min(times), 'median': float(np.median(times))};
+
+def makeField(N, dtype, L=10.0):
+    field = Field('G1', 0, 500e-6, lambda x, y, l: np.zeros(x.shape),
+            lambda x, y, l: np.exp(-(np.square(x) + np.square(y))));
+    x = gridCoordinates(L, N);
+    (x_grid, y_grid) = np.meshgrid(x, x);
+    field.Lx = L;
+    field.Ly = L;
+    field.complex_values = field.complexFunction(x_grid, y_grid, field.wavelength).astype(dtype);
+    return field;
+
+def benchmarkPropagation(sizes, dtypes, repeat):
+    results = [];
+    for N in sizes:
+        for dtype in dtypes:
+            for cached in (False, True):
+                field = makeField(N, dtype);
+                initial = field.complex_values;
+                def propagate():
+                    if(not cached):
+                        transfer_function_cache.clear();
+                    field.complex_values = initial;
+                    field.propagate(10, method='transfer');
+                timing = timeit(propagate, repeat);
+                results.append(dict(name='propagate', size=N, dtype=dtype,
+                        transfer_function='cached' if cached else 'cold',
+                        points_per_second=N*N/timing['min'], **timing));
+    return results;
+
+def benchmarkMasks(sizes, repeat):
+    results = [];
+    for (element_type, line) in ELEMENT_LINES.items():
+        parser = NetlistParser(element_type, text=line);
+        [masks, fields] = parser.parseNetlist();
+        element = (masks + fields)[0];
+        for N in sizes:
+            x = gridCoordinates(10.0, N);
+            (x_grid, y_grid) = np.meshgrid(x, x);
+            timing = timeit(lambda: element.complexFunction(x_grid, y_grid, 500e-6), repeat);
+            results.append(dict(name='complexFunction', element=element_type, size=N,
+                    points_per_second=N*N/timing['min'], **timing));
+            def evaluate():
+                element._value_cache = None; # Always time a cold evaluation
+                element.evaluate(x, x, 500e-6);
+            timing = timeit(evaluate, repeat);
+            results.append(dict(name='evaluate', element=element_type, size=N,
+                    points_per_second=N*N/timing['min'], **timing));
+    return results;
+
+def benchmarkSaving(sizes, dtypes, repeat, directory):
+    results = [];
+    for N in sizes:
+        for dtype in dtypes:
+            field = makeField(N, dtype);
+            if(N <= MAX_TEXT_SIZE):
+                filename = os.path.join(directory, 'field.txt');
+                timing = timeit(lambda: field.saveValues(filename), repeat);
+                results.append(dict(name='saveValues', size=N, dtype=dtype,
+                        bytes=os.path.getsize(filename), **timing));
+            store = ResultStore(os.path.join(directory, 'field.bde'), dtype=dtype);
+            timing = timeit(lambda: store.write(field, 'P1', 'pre_mask'), repeat);
+            results.append(dict(name='ResultStore.write', size=N, dtype=dtype,
+                    bytes=N*N*np.dtype(dtype).itemsize, **timing));
+    return results;
+
+def syntheticNetlist(number_elements):
+    """
+    Returns the text of a large netlist: a Gaussian beam followed by number_elements
+    alternating planes, lenses and apertures.
+    """
+    lines = ['G1 0mm 500nm 2mm', '.grid 20mm 512'];
+    for i in range(number_elements):
+        z = 10*(i + 1);
+        element = ['P', 'L', 'C', 'S'][i % 4];
+        parameter = {'P': '', 'L': ' 1000mm', 'C': ' 8mm', 'S': ' 8mm'}[element];
+        lines.append(f"{element}{i} {z}mm{parameter}");
+    return '\n'.join(lines);
+
+def benchmarkParsing(repeat):
+    results = [];
+    sample = os.path.join(REPOSITORY, 'netlist', 'sample_netlist.txt');
+    timing = timeit(lambda: NetlistParser(sample).parseNetlist(), repeat);
+    results.append(dict(name='parseNetlist', netlist='sample_netlist.txt', **timing));
+    for number_elements in (100, 10000):
+        text = syntheticNetlist(number_elements);
+        timing = timeit(lambda: NetlistParser('synthetic', text=text).parseNetlist(), repeat);
+        results.append(dict(name='parseNetlist', netlist=f"synthetic_{number_elements}", **timing));
+    return results;
+
+def benchmarkEndToEnd(repeat, directory):
+    results = [];
+    synthetic = os.path.join(directory, 'synthetic_netlist.txt');
+    with open(synthetic, 'w') as netlist_file:
+        netlist_file.write(syntheticNetlist(40));
+    netlists = [('sample_netlist.txt', os.path.join(REPOSITORY, 'netlist', 'sample_netlist.txt')),
+            ('synthetic_40', synthetic)];
+    for (name, netlist) in netlists:
+        command = [sys.executable, os.path.join(REPOSITORY, 'main.py'), netlist, '--headless',
+                '--output', os.path.join(directory, 'end_to_end.bde')];
+        run = lambda: subprocess.run(command, cwd=REPOSITORY, check=True, stdout=subprocess.DEVNULL);
+        timing = timeit(run, repeat);
+        results.append(dict(name='main.py', netlist=name, **timing));
+    return results;
+
+def benchmarkKey(result):
+    """
+    Identifies a benchmark, so that it can be matched up with the same one in the baseline.
+    """
+    return tuple(sorted((key, value) for (key, value) in result.items()
+            if key not in MEASURED_KEYS));
+
+def compare(results, baseline, tolerance):
+    """
+    Compares the minimum times against the baseline, and returns a list of the
+    benchmarks that got more than tolerance (as a fraction) slower.
+    """
+    baseline_times = {benchmarkKey(result): result['min'] for result in baseline['results']};
+    regressions = [];
+    for result in results:
+        key = benchmarkKey(result);
+        if(key in baseline_times):
+            ratio = result['min'] / baseline_times[key];
+            result['baseline_ratio'] = ratio;
+            if(ratio > 1 + tolerance):
+                regressions.append(result);
+    return regressions;
+
+def describe(result):
+    details = ', '.join(f"{key}={value}" for (key, value) in result.items()
+            if key != 'name' and key not in MEASURED_KEYS);
+    ratio = f" ({result['baseline_ratio']:.2f}x baseline)" if 'baseline_ratio' in result else '';
+    return f"{result['name']:20s} {details:55s} {result['min']*1e3:10.2f} ms{ratio}";
+
+def main():
+    argument_parser = argparse.ArgumentParser(description="Benchmarks for the diffraction engine");
+    argument_parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES);
+    argument_parser.add_argument('--dtypes', nargs='+', default=DEFAULT_DTYPES);
+    argument_parser.add_argument('--repeat', type=int, default=3);
+    argument_parser.add_argument('--only', nargs='+', default=None,
+            choices=['propagation', 'masks', 'saving', 'parsing', 'end_to_end'],
+            help="Only run these groups of benchmarks");
+    argument_parser.add_argument('--output', default=None, help="Write the results to this JSON file");
+    argument_parser.add_argument('--baseline', default=None, help="JSON results file to compare against");
+    argument_parser.add_argument('--tolerance', type=float, default=0.2,
+            help="Fractional slow-down relative to the baseline that counts as a regression");
+    arguments = argument_parser.parse_args();
+
+    groups = arguments.only or ['propagation', 'masks', 'saving', 'parsing', 'end_to_end'];
+    results = [];
+    with tempfile.TemporaryDirectory() as directory:
+        if('propagation' in groups):
+            results += benchmarkPropagation(arguments.sizes, arguments.dtypes, arguments.repeat);
+        if('masks' in groups):
+            results += benchmarkMasks(arguments.sizes, arguments.repeat);
+        if('saving' in groups):
+            results += benchmarkSaving(arguments.sizes, arguments.dtypes, arguments.repeat, directory);
+        if('parsing' in groups):
+            results += benchmarkParsing(arguments.repeat);
+        if('end_to_end' in groups):
+            results += benchmarkEndToEnd(arguments.repeat, directory);
+
+    regressions = [];
+    if(arguments.baseline is not None):
+        with open(arguments.baseline, 'r') as baseline_file:
+            regressions = compare(results, json.load(baseline_file), arguments.tolerance);
+
+    for result in results:
+        print(describe(result));
+
+    if(arguments.output is not None):
+        with open(arguments.output, 'w') as output_file:
+            json.dump({'machine': machineInfo(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'results': results}, output_file, indent=1);
+
+    if(len(regressions) > 0):
+        print(f"\n{len(regressions)} regressions (more than {arguments.tolerance:.0%} slower than the baseline):");
+        for result in regressions:
+            print(describe(result));
+        sys.exit(1);
+
+if __name__ == '__main__':
+    main();
@@ -0,0 +1,151 @@
+# The Python API for running simulations, which main.py and the simulation server
+# (core/server.py) are both built on. For example:
+#
+#   from core.api import Simulation
+#   simulation = Simulation('netlist/my_netlist.txt');
+#   print(simulation.plan.report());
+#   store = simulation.run('output/my_netlist.bde', render='headless');
+#   values = store.load(store.find(plane='P1', stage='pre_mask')[0]);
+#
+# A Simulation can also be made straight from the text of a netlist, with
+# Simulation(text=..., name=...). Nothing is printed or plotted other than the
+# simulation's own progress, and everything the run needs lives on the object, so a
+# single process can run any number of simulations one after another. The transfer
+# function cache, the FFT plans and the evaluated masks (which are reused for any
+# element with the same definition, see core/scheduler.py) are shared by all of them.
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from core.grid_planner import planGrid, MAX_POINTS, OUT_OF_CORE_MAX_POINTS
+from core.simulation import prepareFields, checkSweep, simulateField
+from core.out_of_core import simulateOutOfCore, checkDiskSpace, STRIP_BYTES
+from core.scheduler import loadNetlist, runParallel, sumSources
+from core.checkpoints import CheckpointCache, DEFAULT_LIMIT_BYTES
+from core.ensemble import runEnsemble
+from core.result_store import ResultStore
+from core.measurements import writeMeasurements
+from plotting.render import makeRenderer, renderStore
+from core import profiling
+
+class Simulation:
+    """
+    A parsed netlist, with its simulation grid planned and its fields prepared, ready
+    to run. precision is the dtype the fields are simulated in (np.complex128 or
+    np.complex64), and out_of_core allows grids too big to keep in memory.
+    """
+    def __init__(self, netlist=None, text=None, name=None, precision=np.complex128, out_of_core=False):
+        if(text is None):
+            with open(netlist, 'r') as netlist_file:
+                text = netlist_file.read();
+        self.text = text;
+        self.name = name if name is not None else os.path.splitext(os.path.basename(netlist or 'netlist'))[0];
+        self.precision = precision;
+        self.out_of_core = out_of_core;
+        (self.parser, self.masks, fields) = loadNetlist(text, netlist or self.name);
+        self.directives = self.parser.directives;
+
+        # Now, using all the masks and fields, figure out what our simulation size needs to
+        # be, and how much we need to discretize it. The grid planner looks at the sizes of
+        # all our sources and apertures, the focal lengths of our lenses, the wavelengths and
+        # the propagation distances, and picks the smallest FFT-friendly grid that doesn't alias.
+        self.plan = planGrid(self.masks, fields, self.directives,
+                OUT_OF_CORE_MAX_POINTS if out_of_core else MAX_POINTS);
+        self.fields = prepareFields(fields, self.directives, precision);
+        self.sweep_z = checkSweep(self.masks, self.directives);
+
+    def run(self, output=None, render='headless', workers=1, sum=None, store_precision=None,
+            checkpoint_directory=None, checkpoint_bytes=DEFAULT_LIMIT_BYTES, save_fields=None):
+        """
+        Runs the simulation, writing every saved plane to a result store at output
+        (output/<name>.bde by default), and returns the store.
+        render is 'headless', 'png', or None to plot inline at the end.
+        workers is the number of processes used for independent sources, .step variants
+        and ensembles. sum is None, 'coherent' or 'incoherent'. store_precision is the
+        dtype of the store (the simulation's precision by default). With a
+        checkpoint_directory, the run resumes from (and adds to) the checkpoints in it.
+        If the netlist asks for measurements (.measure), they are written to a CSV table
+        next to the store, and the fields themselves are only saved (and plotted) if
+        save_fields is True. Otherwise, the fields are always saved.
+        """
+        if(output is None):
+            output = os.path.join('.', 'output', self.name + '.bde');
+        measures = self.directives.get('measure', []);
+        if(save_fields is None):
+            save_fields = (len(measures) == 0);
+        store = ResultStore(output, dtype=self.precision if store_precision is None else store_precision,
+                measures=measures, save_fields=save_fields);
+        output_directory = os.path.dirname(output);
+        if(not save_fields and render != 'headless'):
+            print("Only taking measurements, not saving or plotting the fields");
+            render = 'headless';
+        if(self.out_of_core and render is None):
+            print("Out-of-core fields are too large to plot inline, not plotting (use --png for downsampled plots)");
+            render = 'headless';
+        renderer = makeRenderer(render, output_directory);
+        checkpoints = None if checkpoint_directory is None else CheckpointCache(checkpoint_directory, checkpoint_bytes);
+
+        # That 'Field' object is then propagated to each plane and Mask
+        print("Beginning simulation...");
+        render_store = False; # Whether the planes are plotted from the store once the run is done
+        if(checkpoints is not None and (self.out_of_core or 'ensemble' in self.directives)):
+            print("Checkpoints are not used out of core or for ensembles");
+        if(self.out_of_core):
+            variants = self.runOutOfCore(store, renderer, workers, output_directory);
+        elif('ensemble' in self.directives):
+            # Only the statistics of the intensity over the ensemble are saved, not the fields,
+            # and nothing gets plotted. The realizations are split between the workers.
+            runEnsemble(self.text, self.directives, self.masks, len(self.fields), store, workers, self.precision);
+            if(sum is not None):
+                print("Sources are not summed for ensembles");
+            variants = [];
+        elif(workers > 1 or 'step' in self.directives):
+            # Independent sources and netlist variants are run as separate tasks, in parallel
+            # if we have more than one worker. The workers don't plot anything, so the
+            # planes they saved (and their sums) are plotted from the store once they are all done.
+            variants = runParallel(self.text, self.directives, len(self.fields), store, workers, self.precision,
+                    checkpoint_directory, checkpoint_bytes, save_fields);
+            render_store = (render != 'headless');
+        else:
+            variants = [None];
+            for field in self.fields:
+                simulateField(field, self.masks, self.plan, store, renderer, self.sweep_z, output_directory,
+                        checkpoints=checkpoints);
+            if(checkpoints is not None):
+                print(checkpoints.report());
+
+        # Optionally, sum the contributions of all the sources at each plane
+        if(sum is not None and len(self.fields) > 1):
+            for variant in variants:
+                sumSources(store, sum, variant);
+
+        with profiling.stage('plot'):
+            if(render_store):
+                renderStore(store, renderer);
+            renderer.finish();
+
+        if(len(store.measurements) > 0):
+            table_location = os.path.splitext(output)[0] + '_measurements.csv';
+            writeMeasurements(table_location, store.measurements, measures);
+            print(f"Saved {len(store.measurements)} rows of measurements to {table_location}");
+        store.close();
+        return store;
+
+    def runOutOfCore(self, store, renderer, workers, output_directory):
+        # Each field lives in a scratch file next to the result store, and is only ever in
+        # memory a strip at a time.
+        if(workers > 1 or 'step' in self.directives):
+            print("ERROR: --workers and .step are not supported out of core, running the netlist as written");
+        if(self.sweep_z is not None):
+            print("ERROR: z-sweeps are not supported out of core, skipping the sweep");
+        scratch_directory = tempfile.mkdtemp(prefix='scratch_', dir=output_directory or '.');
+        needed = checkDiskSpace(self.plan, self.fields, scratch_directory);
+        print(f"Out of core: {needed/2**30:.2f} GiB of scratch space per field in {scratch_directory}, " +
+                f"processed in strips of {STRIP_BYTES/2**20:.0f} MiB");
+        try:
+            for field in self.fields:
+                simulateOutOfCore(field, self.masks, self.plan, store, renderer, scratch_directory);
+        finally:
+            shutil.rmtree(scratch_directory);
+        return [None];
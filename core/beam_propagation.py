@@ -0,0 +1,158 @@
+# Thick (volumetric) elements, and the split-step beam propagation engine used to
+# propagate a field through them.
+#
+# A thick element is a region of refractive index n(x, y, z) starting at its location and
+# extending for its thickness along the optical axis, embedded in a background medium of
+# index n0. Rather than turning it into hundreds of separate masks, the field is marched
+# through it with the (symmetric) split-step method: the element is cut into equal slices
+# of thickness dz, and for each slice we
+#   1. propagate through the background medium to the middle of the slice, and
+#   2. multiply by the slice's phase screen exp(i k0 (n - n0) dz),
+# finishing with a final half-slice to the back face. All of the full-slice steps are the
+# same distance in the same medium, so they share a single transfer function from the
+# cache (plus one for the half-slices at either end).
+#
+# The phase screens are generated lazily, one slice at a time, and are computed from
+# the 1D coordinate vectors with broadcasting rather than from full meshgrids. A cylinder
+# only depends on x, so its screens are a single row; screens that are identical for
+# consecutive slices (e.g. every slice of a block) are only computed once.
+# Each screen accounts for the exact length of every ray inside the object within its
+# slice, so the phase through the element doesn't suffer from staircasing.
+#
+# Nothing is saved for the individual slices, only for the planes asked for in the netlist
+# that happen to lie inside the element.
+
+import numpy as np
+from core.fields import Mask
+from core.propagators import transferPropagate
+from core import profiling
+
+DEFAULT_SLICES = 100; # Number of slices used if the netlist doesn't give a slice spacing
+
+class ThickElement(Mask):
+    """
+    A volumetric refractive-index object, occupying [z, z + thickness] along the optical axis.
+    shape is one of:
+        'cylinder' (diameter), with its axis along y
+        'sphere' (diameter)
+        'block' (width, height, thickness)
+        'file', an (nz, ny, nx) array of refractive indices in a .npy file, stretched over
+            (width, height, thickness)
+    All of them are centered on the optical axis.
+    """
+    def __init__(self, ident, location, shape, width, height, thickness, index=None,
+            background_index=1.0, slice_spacing=None, volume=None):
+        super().__init__(ident, location);
+        self.is_passive_plane = False;
+        self.shape = shape;
+        self.width = width;
+        self.height = height;
+        self.thickness = thickness;
+        self.index = index;
+        self.background_index = background_index;
+        self.volume = volume; # Memory-mapped index volume, for shape 'file'
+        if(slice_spacing is None):
+            slice_spacing = thickness / DEFAULT_SLICES;
+        # Round the slice spacing down so the slices exactly fill the element
+        self.number_slices = max(1, int(np.ceil(thickness / slice_spacing - 1e-9)));
+        self.slice_spacing = thickness / self.number_slices;
+        self.parameters = {'width': width, 'height': height, 'thickness': thickness};
+
+    def opticalPath(self, x, y, start, stop):
+        """
+        Returns the extra optical path (n - n0) * length through the slice of the element
+        from depth start to stop (relative to its front face), as an array which broadcasts
+        against the (y, x) grid with 1D coordinate vectors x and y. For the cylinder and
+        sphere, the length is the exact length of each (x, y) ray inside the object within
+        the slice, rather than just whether the middle of the slice is inside, so the total
+        phase through the object is right however coarse the slices are.
+        Along with it, returns a key which is the same for any two slices with the same
+        optical path, so that their phase screens can be reused.
+        """
+        delta_n = 0 if self.index is None else self.index - self.background_index;
+        # Relative to the center of the element
+        (start, stop) = (start - self.thickness/2, stop - self.thickness/2);
+        if(self.shape == 'cylinder'):
+            half_chord = np.sqrt(np.maximum(0, np.square(self.width/2) - np.square(x)));
+            length = np.clip(np.minimum(stop, half_chord) - np.maximum(start, -half_chord), 0, None);
+            return (delta_n * length[None, :], (start, stop));
+        elif(self.shape == 'sphere'):
+            half_chord = np.sqrt(np.maximum(0, np.square(self.width/2) - np.square(x)[None, :] - np.square(y)[:, None]));
+            length = np.clip(np.minimum(stop, half_chord) - np.maximum(start, -half_chord), 0, None);
+            return (delta_n * length, (start, stop));
+        elif(self.shape == 'block'):
+            inside = np.outer(np.abs(y) <= self.height/2, np.abs(x) <= self.width/2);
+            return (delta_n * (stop - start) * inside, stop - start);
+        else: # 'file': nearest-neighbour sampling of the index volume, at the middle of the slice
+            (nz, ny, nx) = self.volume.shape;
+            iz = min(nz - 1, int(((start + stop)/2 / self.thickness + 0.5) * nz));
+            ix = np.floor((x + self.width/2) / self.width * nx).astype(int);
+            iy = np.floor((y + self.height/2) / self.height * ny).astype(int);
+            inside = np.outer((iy >= 0) & (iy < ny), (ix >= 0) & (ix < nx));
+            plane = np.asarray(self.volume[iz])[np.clip(iy, 0, ny-1)[:, None], np.clip(ix, 0, nx-1)[None, :]];
+            return (np.where(inside, plane - self.background_index, 0) * (stop - start), (iz, stop - start));
+
+    def phaseScreens(self, x, y, wavelength, dtype=np.complex128):
+        """
+        Lazily yields the phase screen exp(i k0 (n - n0) dz) for each slice, in order.
+        wavelength may be a (wavelength, 1, 1) column, giving a stack of screens.
+        """
+        k0 = 2*np.pi / np.asarray(wavelength);
+        previous_key = None;
+        screen = None;
+        for k in range(self.number_slices):
+            (optical_path, key) = self.opticalPath(x, y, k*self.slice_spacing, (k + 1)*self.slice_spacing);
+            if(screen is None or key != previous_key):
+                screen = np.exp(1j * k0 * optical_path).astype(dtype);
+                previous_key = key;
+            yield screen;
+
+def splitStepPropagate(field, element, x, y, planes=[], save=None):
+    """
+    Propagates field (which must be at the front face of element) through the element
+    with the split-step method, leaving it at the back face. x and y are the 1D grid
+    coordinates of the field. save(plane) is called whenever the field reaches one of the
+    (passive) planes in planes, which must lie inside the element.
+    """
+    (M, N) = field.complex_values.shape[-2:];
+    dx = field.Lx/N;
+    dy = field.Ly/M;
+    # Inside the element, the field propagates with the wavelength in the background medium
+    medium_wavelength = field.wavelengthSamples() / element.background_index;
+    start = field.z;
+    planes = sorted(planes, key=lambda plane: plane.z);
+    print(f"Propagating {field.ident} through {element.ident} ({element.shape}) in " +
+            f"{element.number_slices} slices of {element.slice_spacing:g}mm");
+
+    position = 0; # Depth of the field inside the element
+
+    def advance(distance):
+        # Propagates distance further through the background medium, stopping at any planes
+        # on the way. The distances are passed on exactly as given (rather than recomputed
+        # from the depth), so that every slice gets the same transfer function from the cache.
+        nonlocal position
+        end = position + distance;
+        while(len(planes) > 0 and planes[0].z - start <= end):
+            plane = planes.pop(0);
+            step(plane.z - start - position);
+            position = plane.z - start;
+            field.z = plane.z;
+            if(save is not None):
+                save(plane);
+            distance = end - position;
+        step(distance);
+        position = end;
+        field.z = start + position;
+
+    def step(distance):
+        if(distance > 0):
+            (field.complex_values, _, _) = transferPropagate(field.complex_values, dx, dy,
+                    medium_wavelength, distance, in_place=True);
+
+    with profiling.stage('split_step', field=field.ident, element=element.ident, slices=element.number_slices):
+        screens = element.phaseScreens(x, y, field.wavelengthGrid(), field.complex_values.dtype);
+        for (k, screen) in enumerate(screens):
+            advance(element.slice_spacing/2 if k == 0 else element.slice_spacing);
+            field.complex_values *= screen;
+        advance(element.slice_spacing/2);
+    field.z = start + element.thickness;
@@ -0,0 +1,197 @@
+# On-disk checkpoints of the field after each element, for incremental re-simulation.
+#
+# When only an element near the end of a long netlist changes, everything upstream of it
+# comes out exactly the same as last time. So after each propagation step (from one
+# element to the next, and through that element), we save what the step produced into a
+# checkpoint: a small result store holding every plane saved during the step, the last of
+# which is the state of the field once it is through the element.
+#
+# Each checkpoint is keyed by a hash of everything that determines the field at that point:
+# the source's definition line, its wavelength(s), the precision, the simulation grid, and
+# the definition lines of every element up to and including this one, in order (for a thick
+# element, along with the planes inside it), and the size and modification time of any
+# data files they were loaded from. When the netlist is re-run, we find the last
+# step whose checkpoint (and every checkpoint before it) still exists, copy the planes they
+# hold into the result store as if we had just computed them, and carry on propagating from
+# there. Any edit to an element changes the keys of it and everything after it, but none
+# of the keys before it.
+#
+# Checkpoints are stored in the precision of the field, so that resuming from one gives
+# exactly the same result as not. The cache directory is kept under a size limit by
+# removing the least-recently used checkpoints, and the later steps of a chain before the
+# earlier ones (which are needed to resume from any of them).
+# Steps after the start of a z-sweep are never skipped, since the sweep needs the field.
+
+import hashlib
+import os
+import time
+import numpy as np
+from core.result_store import ResultStore
+from core import profiling
+
+CHECKPOINT_VERSION = 1; # Bump this whenever a change to the simulator changes its results
+DEFAULT_LIMIT_BYTES = 4*2**30;
+
+class CheckpointCache:
+    """
+    A directory of field checkpoints, holding at most max_bytes of them.
+    """
+    def __init__(self, directory, max_bytes=DEFAULT_LIMIT_BYTES):
+        self.directory = directory;
+        self.max_bytes = max_bytes;
+        os.makedirs(directory, exist_ok=True);
+        self.evict(); # In case the limit has come down since the checkpoints were saved
+        self.total_steps = 0;
+        self.skipped_steps = 0;
+        self.skipped_seconds = 0;
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.bde');
+
+    def chainKeys(self, field, masks, plan):
+        """
+        Returns a dictionary of the checkpoint key of each propagation step, indexed by the
+        position of the step's element in masks. Elements the field never stops at (those
+        before the source, or inside a thick element) have no step. Returns no keys at all
+        if any of the elements didn't come from a netlist line, since we couldn't tell
+        whether they had changed.
+        """
+        if(field.definition == '' or any(mask.definition == '' for mask in masks)):
+            return {};
+        digest = hashlib.sha256(repr((CHECKPOINT_VERSION, field.definition,
+                np.ravel(field.wavelengthSamples()).tolist(), np.dtype(field.dtype).str,
+                float(plan.size_x), float(plan.size_y), plan.N_x, plan.N_y)).encode());
+        keys = {};
+        z = field.z;
+        for (i, mask) in enumerate(masks):
+            if(mask.z < z):
+                continue;
+            inside = [other.definition for other in masks if mask.z < other.z < mask.z + mask.thickness];
+            digest.update(repr((mask.definition, inside, fileStamps(mask))).encode());
+            keys[i] = digest.hexdigest();
+            z = mask.z + mask.thickness;
+        return keys;
+
+    def open(self, key):
+        """
+        Returns the checkpoint with the given key, or None if there isn't one.
+        """
+        try:
+            checkpoint = ResultStore.open(self.path(key));
+        except FileNotFoundError: # Never saved, or evicted (perhaps by another process)
+            return None;
+        return checkpoint;
+
+    def resume(self, masks, keys, sweep_z=None):
+        """
+        Returns the checkpoints of the longest run of steps, from the first one, which are
+        all in the cache, along with the position in masks of the element to carry on from.
+        """
+        checkpoints = [];
+        start = 0;
+        for (i, key) in keys.items():
+            if(sweep_z is not None and masks[i].z > sweep_z[0]):
+                break;
+            checkpoint = self.open(key);
+            if(checkpoint is None):
+                break;
+            checkpoints.append(checkpoint);
+            start = i + 1;
+        self.touch([keys[i] for i in keys if i < start]);
+        self.total_steps += len(keys);
+        self.skipped_steps += len(checkpoints);
+        self.skipped_seconds += sum(checkpoint.planes[0].get('seconds', 0) for checkpoint in checkpoints);
+        return (checkpoints, start);
+
+    def begin(self, key, field):
+        """
+        Returns a new (partial) checkpoint, to write the planes of a step into.
+        """
+        return ResultStore(f"{self.path(key)}.{os.getpid()}.partial", dtype=field.dtype);
+
+    def commit(self, checkpoint, key, seconds, chain):
+        """
+        Moves a finished checkpoint into place, recording how long its step took to compute,
+        and then evicts old checkpoints if the cache is over its size limit. chain is the
+        list of keys of every step up to and including this one.
+        """
+        if(len(checkpoint.planes) > 0):
+            checkpoint.planes[0]['seconds'] = seconds;
+        checkpoint.writeIndex();
+        path = self.path(key);
+        os.replace(checkpoint.path, path);
+        os.replace(checkpoint.index_path, path + '.json'); # The index last, since it marks the checkpoint as present
+        self.touch(chain);
+        self.evict();
+
+    def touch(self, chain):
+        """
+        Marks the checkpoints of a chain of steps as just used. A checkpoint is no use
+        without every one before it, so the earlier steps are marked as used slightly more
+        recently than the later ones, and are evicted after them.
+        """
+        now = time.time_ns();
+        for (position, key) in enumerate(chain):
+            try:
+                os.utime(self.path(key) + '.json', ns=(now - 1000*position,)*2);
+            except FileNotFoundError:
+                pass;
+
+    def evict(self):
+        """
+        Removes the least-recently used checkpoints until the cache fits in max_bytes.
+        """
+        entries = [];
+        for name in os.listdir(self.directory):
+            if(name.endswith('.bde.json')):
+                index_path = os.path.join(self.directory, name);
+                try:
+                    size = os.path.getsize(index_path) + os.path.getsize(index_path[:-5]);
+                    entries.append((os.path.getmtime(index_path), size, index_path));
+                except FileNotFoundError:
+                    continue;
+        total = sum(size for (_, size, _) in entries);
+        for (_, size, index_path) in sorted(entries):
+            if(total <= self.max_bytes):
+                break;
+            for path in (index_path, index_path[:-5]):
+                try:
+                    os.remove(path);
+                except FileNotFoundError:
+                    pass;
+            total -= size;
+
+    def counts(self):
+        return (self.skipped_steps, self.total_steps, self.skipped_seconds);
+
+    def report(self):
+        return checkpointReport(*self.counts());
+
+def checkpointReport(skipped_steps, total_steps, skipped_seconds):
+    return (f"Checkpoints: skipped {skipped_steps} of {total_steps} propagation steps " +
+            f"(about {skipped_seconds:.3g}s of computation)");
+
+def fileStamps(mask):
+    """
+    Identifies the contents of the data files an element was loaded from by their size and
+    modification time, so that changing a file invalidates the checkpoints that used it.
+    """
+    stamps = [];
+    for path in mask.files:
+        status = os.stat(path);
+        stamps.append((path, status.st_size, status.st_mtime_ns));
+    return stamps;
+
+def replay(field, checkpoints, save):
+    """
+    Saves every plane held in the checkpoints with save(plane, stage), as if the field had
+    just been propagated there, leaving the field in the state of the last one.
+    """
+    with profiling.stage('checkpoint', field=field.ident, steps=len(checkpoints)):
+        for checkpoint in checkpoints:
+            for (i, entry) in enumerate(checkpoint.planes):
+                field.complex_values = checkpoint.load(i);
+                (field.z, field.Lx, field.Ly) = (entry['z'], entry['Lx'], entry['Ly']);
+                save(entry['plane'], entry['stage']);
+        # The field is propagated in place from here on, so it needs its own copy
+        field.complex_values = np.array(field.complex_values, dtype=field.dtype);
@@ -0,0 +1,76 @@
+# Random phase diffusers, for simulating speckle.
+#
+# A diffuser is a thin mask exp(i phi(x, y)) whose phase is a stationary Gaussian random
+# field with zero mean, a standard deviation of phase_std radians, and a Gaussian
+# autocorrelation <phi(r) phi(r + d)> = phase_std^2 exp(-|d|^2 / correlation_length^2).
+# Each realization is generated by filtering white noise in the Fourier domain with the
+# square root of the matching power spectrum, which is separable in fx and fy.
+#
+# Every realization comes from its own random stream, seeded with (seed, realization), so
+# any realization can be regenerated on its own, whichever batch or worker process it
+# ends up in. In an ordinary simulation a diffuser is a fixed mask (realization 0). The
+# ensemble engine (core/ensemble.py) sets realizations to the batch it is simulating, and
+# the diffuser then evaluates to a (realization, y, x) stack of screens instead.
+
+import zlib
+import numpy as np
+from core.fields import Mask
+from core.fourier import fft2, ifft2
+from core import profiling
+
+DEFAULT_PHASE_STD = 2*np.pi; # Strong enough for fully-developed speckle
+
+class Diffuser(Mask):
+    """
+    A random phase screen with the given correlation length (in mm) and RMS phase
+    (in radians). If no seed is given, it is derived from the identifier, so that two
+    diffusers in the same netlist are independent of each other.
+    """
+    def __init__(self, ident, location, correlation_length, phase_std=DEFAULT_PHASE_STD, seed=None):
+        super().__init__(ident, location);
+        self.is_passive_plane = False;
+        self.is_random = True;
+        self.wavelength_independent = True;
+        self.correlation_length = correlation_length;
+        self.phase_std = phase_std;
+        self.seed = zlib.crc32(ident.encode()) if seed is None else seed;
+        self.parameters = {'correlation_length': correlation_length, 'phase_std': phase_std};
+
+    realizations = None; # The realizations to evaluate as a stack, set by the ensemble engine
+
+    def phaseScreens(self, x, y, realizations):
+        """
+        Returns the (realization, y, x) stack of phases of the given realizations, on the
+        grid with 1D coordinate vectors x and y.
+        """
+        (M, N) = (y.size, x.size);
+        dx = x[1] - x[0] if N > 1 else 1;
+        dy = y[1] - y[0] if M > 1 else 1;
+        noise = np.empty((len(realizations), M, N));
+        for (k, realization) in enumerate(realizations):
+            noise[k] = np.random.default_rng([self.seed, realization]).standard_normal((M, N));
+
+        # The square root of the power spectrum of a Gaussian autocorrelation, which is
+        # real and even, so the filtered noise stays real.
+        gx = np.exp(-np.square(np.pi * self.correlation_length * np.fft.fftfreq(N, dx)) / 2);
+        gy = np.exp(-np.square(np.pi * self.correlation_length * np.fft.fftfreq(M, dy)) / 2);
+        spectrum = fft2(noise, overwrite=True);
+        spectrum *= gy[:, None];
+        spectrum *= gx[None, :];
+        phase = ifft2(spectrum, overwrite=True).real;
+        # White noise with unit variance comes out of the filter with a variance of mean(g^2)
+        phase *= self.phase_std / np.sqrt(np.mean(np.square(gx)) * np.mean(np.square(gy)));
+        return phase;
+
+    def sample(self, x, y, l, dtype=np.complex128):
+        return np.exp(1j*self.phaseScreens(x, y, [0])[0]).astype(dtype);
+
+    def evaluate(self, x, y, l, dtype=np.complex128):
+        """
+        Returns realization 0 (cached, like any other mask), or if the ensemble engine
+        has set realizations, a fresh stack with one screen per realization.
+        """
+        if(self.realizations is None):
+            return super().evaluate(x, y, l, dtype);
+        with profiling.stage('mask', mask=self.ident, realizations=len(self.realizations)):
+            return np.exp(1j*self.phaseScreens(x, y, self.realizations)).astype(dtype);
@@ -0,0 +1,241 @@
+# Ensemble simulations of random media, e.g. speckle from a random phase diffuser.
+#
+# With an '.ensemble <N> [batch]' directive, every source is propagated through N
+# independent realizations of the random masks in the netlist (core/diffuser.py), and
+# rather than the fields themselves, we save the statistics of the intensity over the
+# ensemble at every plane from the first random mask onwards:
+#   mean_intensity   <I>
+#   variance         the sample variance of I
+#   contrast         sqrt(variance) / <I>, which is 1 for fully-developed speckle
+#   autocorrelation  the autocovariance of the intensity, <I(r) I(r + d)> - <I(r)><I(r + d)>
+#                    averaged over r (circularly) and normalized to one at d = 0, with
+#                    d = 0 at the center [M//2, N//2]. Its width is the speckle size.
+#
+# Realizations are propagated in batches, as a (realization, y, x) stack, so every step of
+# a batch is a single batched FFT with a single transfer function from the cache, which the
+# following batches reuse too. The propagator for each step is chosen for the first batch
+# and kept for the rest, so that every realization of a plane ends up on the same grid.
+# Each batch is folded into the running statistics and then thrown away, so individual
+# realizations are never stored and the memory needed doesn't depend on N. The running
+# statistics use the parallel form of Welford's algorithm (Chan et al.), which combines the
+# count, mean and sum of squared deviations of two sets of samples exactly, so batches (and
+# the partial statistics from each worker) can be combined without a second pass.
+#
+# The part of the system before the first random mask is the same for every realization,
+# so it is only propagated once per task, and isn't saved.
+# The realizations of each source are split into one contiguous range per worker process.
+# Every realization is seeded with its own index, so the results don't depend on the
+# number of workers or the batch size (beyond rounding).
+
+from collections import OrderedDict
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from core.fourier import fft2, ifft2
+from core.grid_planner import planGrid
+from core.propagators import choosePropagator
+from core.simulation import prepareFields, sampleSource, applyMask
+from core.scheduler import loadNetlist
+from core import profiling
+
+ENSEMBLE_BATCH_BYTES = 256*2**20; # Rough upper bound on the memory used by a batch
+BATCH_BYTES_PER_POINT = 64; # Field, screens, intensity and its spectrum, per realization
+VARIANCE_TOLERANCE = 1e-10; # Relative variance below which the intensity is taken to be deterministic
+
+class IntensityStatistics:
+    """
+    Running statistics of the intensity at one plane over an ensemble of realizations.
+    """
+    def __init__(self, metadata):
+        self.metadata = metadata; # field, plane, stage, z, wavelength, Lx, Ly
+        self.count = 0;
+        self.mean = 0;
+        self.squares = 0; # Sum of the squared deviations from the mean
+        self.correlation = 0; # Mean autocorrelation of the intensity
+
+    def update(self, intensity):
+        """
+        Folds a (realization, y, x) stack of intensities into the statistics.
+        """
+        intensity = np.asarray(intensity, dtype=float);
+        batch = IntensityStatistics(self.metadata);
+        batch.count = intensity.shape[0];
+        batch.mean = intensity.mean(axis=0);
+        batch.squares = np.square(intensity - batch.mean).sum(axis=0);
+        batch.correlation = autocorrelation(intensity).mean(axis=0);
+        self.merge(batch);
+
+    def merge(self, other):
+        """
+        Combines the statistics of another set of realizations into these ones.
+        """
+        if(other.count == 0):
+            return;
+        if(self.count == 0):
+            (self.count, self.mean, self.squares, self.correlation) = (other.count, other.mean,
+                    other.squares, other.correlation);
+            return;
+        count = self.count + other.count;
+        delta = other.mean - self.mean;
+        self.mean = self.mean + delta * (other.count / count);
+        self.squares = self.squares + other.squares + np.square(delta) * (self.count * other.count / count);
+        self.correlation = self.correlation + (other.correlation - self.correlation) * (other.count / count);
+        self.count = count;
+
+    def variance(self):
+        return self.squares / max(1, self.count - 1);
+
+    def contrast(self):
+        deviation = np.sqrt(self.variance());
+        return np.divide(deviation, self.mean, out=np.zeros_like(deviation), where=self.mean > 0);
+
+    def meanContrast(self):
+        """
+        The contrast averaged over the plane, weighted by the mean intensity.
+        """
+        total = np.sum(self.mean);
+        return np.sum(np.sqrt(self.variance())) / total if total > 0 else 0;
+
+    def autocovariance(self):
+        covariance = np.fft.fftshift(self.correlation - autocorrelation(self.mean[None])[0]);
+        (M, N) = covariance.shape;
+        zero = covariance[M//2, N//2];
+        # A plane which is the same in every realization has nothing but rounding errors left
+        if(zero <= VARIANCE_TOLERANCE * np.mean(np.square(self.mean))):
+            return np.zeros_like(covariance);
+        return covariance / zero;
+
+def autocorrelation(intensity):
+    """
+    Returns the circular autocorrelation (1/MN) sum_r I(r) I(r + d) of each plane in a
+    (realization, y, x) stack, in FFT order (d = 0 at [0, 0]).
+    """
+    (M, N) = intensity.shape[-2:];
+    spectrum = fft2(intensity);
+    spectrum *= spectrum.conj();
+    return ifft2(spectrum, overwrite=True).real / (M*N);
+
+def batchSize(plan):
+    return max(1, ENSEMBLE_BATCH_BYTES // (BATCH_BYTES_PER_POINT * plan.N_x * plan.N_y));
+
+def simulateEnsemble(field, masks, plan, realizations, batch_size=None):
+    """
+    Propagates the given realizations of the random masks for a single source, a batch
+    at a time. Returns an ordered dictionary of the IntensityStatistics at each
+    (plane, stage) from the first random mask onwards.
+    """
+    batch_size = batchSize(plan) if batch_size is None else batch_size;
+    random_masks = [mask for mask in masks if mask.is_random];
+    first = masks.index(random_masks[0]);
+    print(f"Simulating {len(realizations)} realizations of {field.ident} in batches of {batch_size}");
+
+    # Everything before the first random mask is the same for every realization
+    sampleSource(field, plan);
+    for mask in masks[:first]:
+        if(mask.z >= field.z):
+            field.propagate(mask.z - field.z, in_place=True);
+            applyMask(field, mask, masks, plan, lambda plane, stage: None);
+    common = (field.complex_values, field.z, field.Lx, field.Ly);
+
+    statistics = OrderedDict();
+    def accumulate(plane, stage):
+        if((plane, stage) not in statistics):
+            statistics[(plane, stage)] = IntensityStatistics({'field': field.ident, 'plane': plane,
+                    'stage': stage, 'z': float(field.z), 'wavelength': np.ravel(field.wavelengthSamples()).tolist(),
+                    'Lx': float(field.Lx), 'Ly': float(field.Ly)});
+        with profiling.stage('statistics', field=field.ident, plane=plane, stage=stage):
+            statistics[(plane, stage)].update(np.square(np.abs(field.complex_values)));
+
+    choices = {}; # The propagator (and output pitch) for each step, from the first batch
+    for start in range(0, len(realizations), batch_size):
+        batch = realizations[start:start + batch_size];
+        for mask in random_masks:
+            mask.realizations = batch;
+        (values, field.z, field.Lx, field.Ly) = common;
+        field.complex_values = np.repeat(values[None], len(batch), axis=0);
+        with profiling.stage('ensemble_batch', field=field.ident, realizations=len(batch)):
+            for (i, mask) in enumerate(masks[first:], first):
+                if(mask.z < field.z): # Inside a thick element, already accumulated
+                    continue;
+                distance = mask.z - field.z;
+                if(distance > 0 and i not in choices):
+                    (M, N) = field.complex_values.shape[-2:];
+                    choices[i] = choosePropagator(field.complex_values, field.Lx/N, field.Ly/M,
+                            field.wavelengthSamples(), distance);
+                if(distance > 0):
+                    field.propagate(distance, *choices[i], in_place=True);
+                accumulate(mask.ident, 'pre_mask');
+                applyMask(field, mask, masks, plan, accumulate);
+
+    for mask in random_masks:
+        mask.realizations = None;
+    field.complex_values = np.array([]);
+    return statistics;
+
+def runEnsembleTask(task):
+    """
+    Simulates a range of realizations for a single source, returning their statistics.
+    This runs in a worker process.
+    """
+    (text, source_index, start, stop, batch_size, precision) = task;
+    first_event = len(profiling.active.events) if profiling.active is not None else 0;
+    (parser, masks, fields) = loadNetlist(text);
+    fields = prepareFields(fields, parser.directives, precision);
+    plan = planGrid(masks, fields, parser.directives);
+    statistics = simulateEnsemble(fields[source_index], masks, plan, range(start, stop), batch_size);
+    events = profiling.active.events[first_event:] if profiling.active is not None else [];
+    return (statistics, events);
+
+def runEnsemble(text, directives, masks, number_sources, store, workers=1, precision=np.complex128):
+    """
+    Runs the ensemble asked for by the .ensemble directive for every source, splitting
+    the realizations of each source between the workers, and writes the statistics of
+    each plane to store (with a 'quantity' and the number of 'realizations').
+    """
+    (number_realizations, batch_size) = directives['ensemble'];
+    if(not any(mask.is_random for mask in masks)):
+        print("ERROR: .ensemble needs at least one random mask (e.g. a diffuser), skipping the ensemble");
+        return;
+    if('poly' in directives):
+        print("ERROR: Ensembles are only supported for monochromatic simulations, skipping the ensemble");
+        return;
+    if('step' in directives or 'sweep' in directives):
+        print("WARNING: .step and .sweep are ignored for ensembles");
+    if('measure' in directives):
+        print("WARNING: .measure is ignored for ensembles");
+
+    ranges = [(chunk[0], chunk[-1] + 1) for chunk in np.array_split(np.arange(number_realizations), workers)
+            if chunk.size > 0];
+    tasks = [(text, source_index, int(start), int(stop), batch_size, np.dtype(precision).str)
+            for source_index in range(number_sources) for (start, stop) in ranges];
+    print(f"Running {number_realizations} realizations of {number_sources} sources as {len(tasks)} tasks on {workers} workers");
+
+    if(workers > 1):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(runEnsembleTask, tasks));
+        if(profiling.active is not None):
+            for (statistics, events) in results:
+                profiling.active.merge(events);
+    else:
+        results = [runEnsembleTask(task) for task in tasks];
+
+    for source_index in range(number_sources):
+        combined = OrderedDict();
+        for (task, (statistics, events)) in zip(tasks, results):
+            if(task[1] != source_index):
+                continue;
+            for (key, partial) in statistics.items():
+                if(key not in combined):
+                    combined[key] = IntensityStatistics(partial.metadata);
+                combined[key].merge(partial);
+        writeStatistics(store, combined);
+
+def writeStatistics(store, statistics):
+    for entry in statistics.values():
+        metadata = dict(entry.metadata, realizations=entry.count);
+        store.writePlane(entry.mean, quantity='mean_intensity', **metadata);
+        store.writePlane(entry.variance(), quantity='variance', **metadata);
+        store.writePlane(entry.contrast(), quantity='contrast', **metadata);
+        store.writePlane(entry.autocovariance(), quantity='autocorrelation', **metadata);
+        print(f"{metadata['field']} at {metadata['plane']} ({metadata['stage']}): speckle contrast " +
+                f"{entry.meanContrast():.3f} over {entry.count} realizations");
+    store.flush();
@@ -8,13 +8,13 @@
 # and all units are assumed to be millimeters.
 # TODO:
 # 1. Add Fresnel Number / Error calculation in fresnelPropagate
-# 2. Add impulse-response based fresnel propagator
-# 3. Add warnings if the source (the majority of the intensity) does not *fit* within
+# 2. Add warnings if the source (the majority of the intensity) does not *fit* within
 # the aperture (L > 2-3*Dsource). 
-# 4. Choose the field sampling so we appropriately oversample our stuff and don't alias anything.
 
+from collections import OrderedDict
 import numpy as np
-import matplotlib.pyplot as plt
+from core.propagators import PROPAGATORS, scaledPropagate, choosePropagator
+from core import profiling
 
 class Mask:
     """
@@ -29,9 +29,15 @@ class Mask:
         self.phaseFunction = phaseFunction;
         self.amplitudeFunction = amplitudeFunction;
         self.realFunction = realFunction;
-        self.imaginaryFuunction = imaginaryFunction;
+        self.imaginaryFunction = imaginaryFunction;
 
         self.complex_values =  complex_values;
+        self.parameters = {};
+
+        # A plane has no functions at all, and just marks a location at which we want
+        # to know the field. We never need to evaluate it.
+        self.is_passive_plane = (phaseFunction is None and amplitudeFunction is None and
+                realFunction is None and imaginaryFunction is None);
 
     ident = '';
     z = 0;
@@ -43,6 +49,25 @@ class Mask:
     imaginaryFunction = None;
 
     complex_values = np.array([]); # Raw complex values for the mask (a 2D array)
+    parameters = {}; # Physical parameters from the netlist (aperture width, focal length, etc.)
+    definition = ''; # The netlist line that defined this element, used to key its checkpoints
+    files = (); # Any data files the element was loaded from, whose contents are part of its definition too
+
+    is_passive_plane = False;
+    thickness = 0; # Extent along the optical axis. Only thick elements (core/beam_propagation.py) have one.
+    wavelength_independent = False; # True if the mask is the same at every wavelength (e.g. apertures)
+    is_random = False; # True for masks which differ between the realizations of an ensemble (core/diffuser.py)
+    # For masks whose amplitude is a product f(x)*g(y) with no phase, (f, g) as functions of
+    # a 1D coordinate vector, so the mask can be built as an outer product.
+    separableAmplitude = None;
+
+    # Evaluated complex values, keyed by the grid and the wavelength(s). Most of the time
+    # every field is on the same grid, so each mask only needs to be evaluated once per
+    # wavelength, or just once if it doesn't depend on the wavelength.
+    MAX_CACHED_VALUES = 8;
+    _value_cache = None;
+    cache_hits = 0;
+    cache_misses = 0;
 
     def complexFunction(self, x, y, l):
         """ Return a complex-valued function depending on whether we have
@@ -57,10 +82,51 @@ class Mask:
         else:
             return None;
 
+    def evaluate(self, x, y, l, dtype=np.complex128):
+        """
+        Returns the complex values of the mask on the grid with 1D coordinate vectors x and y,
+        at the wavelength(s) l, using the cached values if we have already evaluated them.
+        The values are computed in double precision and then converted to dtype.
+        The returned array is shared between calls, and so is read-only.
+        """
+        if(self._value_cache is None):
+            self._value_cache = OrderedDict();
+        grid_key = (x.size, float(x[0]), float(x[-1]), y.size, float(y[0]), float(y[-1]));
+        wavelength_key = None if self.wavelength_independent else tuple(np.ravel(l).tolist());
+        key = (grid_key, wavelength_key, np.dtype(dtype).str);
+        if(key in self._value_cache):
+            self.cache_hits += 1;
+            with profiling.stage('mask', mask=self.ident, cache='hit'):
+                self._value_cache.move_to_end(key);
+            return self._value_cache[key];
+
+        self.cache_misses += 1;
+        with profiling.stage('mask', mask=self.ident, cache='miss'):
+            values = self.sample(x, y, l, dtype);
+        values.setflags(write=False);
+        self._value_cache[key] = values;
+        if(len(self._value_cache) > self.MAX_CACHED_VALUES):
+            self._value_cache.popitem(last=False);
+        return values;
+
+    def sample(self, x, y, l, dtype=np.complex128):
+        """
+        Evaluates the complex values of the mask on the grid with 1D coordinate vectors x
+        and y, without any caching. Used directly for the tiles of out-of-core fields.
+        """
+        if(self.separableAmplitude is not None):
+            (amplitude_x, amplitude_y) = self.separableAmplitude;
+            return np.outer(amplitude_y(y), amplitude_x(x)).astype(dtype);
+        (x_grid, y_grid) = np.meshgrid(x, y);
+        return np.asarray(self.complexFunction(x_grid, y_grid, l), dtype=dtype);
+
     def plotMagPhase(self, title=''):
         """
         Plots the magnitude and phase of the electromagnetic field object
         """
+        # matplotlib is only imported when we actually plot something, since it is slow to
+        # import and isn't needed at all for headless runs.
+        import matplotlib.pyplot as plt
         if(self.complex_values.size > 0):
             fig, (ax1, ax2) = plt.subplots(nrows=1,ncols=2,figsize=(7,7))
             ax1.set_xlabel('x(mm)')
@@ -102,58 +168,87 @@ class Field(Mask):
         self.wavelength = wavelength;
         self.phaseFunction = phaseFunction;
         self.amplitudeFunction = amplitudeFunction;
+        self.parameters = {};
 
     wavelength = 0; # Wavelength of the monochromatic field.
+    dtype = np.complex128; # Precision the field is sampled and propagated in (or np.complex64)
+
+    def wavelengthSamples(self):
+        """
+        Returns the wavelength(s) carried by this field, used to build transfer functions.
+        """
+        return self.wavelength;
 
+    def wavelengthGrid(self):
+        """
+        Returns the wavelength(s) carried by this field in a form that can be passed as
+        the 'l' argument of an amplitude/phase function evaluated on an (x, y) grid.
+        """
+        return self.wavelength;
 
     def fresnelPropagate(self, distance):
         """Propagate an electromagnetic field from one location to another using the Fresnel
-        u1: Electromagnetic field to propagate at some initial plane
-        L: side length of both the initial and final plane, in mm
-        z: distance to propagate the field, in mm
+        transfer function, regardless of whether it is well-sampled.
+        distance: distance to propagate the field, in mm
         """
-        if(distance > 0):
-            field_shape = self.complex_values.shape;
-            print(f"field shape is {field_shape}")
-            k0 = 2*np.pi / self.wavelength;
+        return self.propagate(distance, method='transfer');
 
+    def propagate(self, distance, method='auto', output_pitch=None, in_place=False):
+        """Propagate an electromagnetic field from one location to another.
+        distance: distance to propagate the field, in mm
+        method: one of 'transfer', 'impulse', 'fraunhofer' or 'scaled' (see core/propagators.py),
+            or 'auto' to choose the cheapest propagator which stays accurate for this step.
+        output_pitch: pixel pitch (out_dx, out_dy) of the propagated field, for the scaled
+            propagator. A single number is used for both axes.
+        in_place: reuse the array holding the field's values for the result where possible,
+            rather than allocating new ones. Only safe if nothing else refers to that array.
+        The Fraunhofer and scaled propagators change the pixel pitch, and hence
+        Lx and Ly, of the field. Returns the oversampling ratio of the transfer function.
+        """
+        if(distance > 0):
+            field_shape = self.complex_values.shape[-2:]; # The last two axes are always (y, x)
             M = field_shape[0];
             N = field_shape[1];
             dx = self.Lx/N;
             dy = self.Ly/M;
 
-            print(f"dx: {dx}, dy: {dy}");
-
             # This is our oversampling ratio for the transfer function propagator.
             # ideally, we want this to be much greater than one for appropriate sampling
-            # of our phase function. We want this number to be much greater than 1.
-
-            # These are the frequencies we can represent on our discretized grid.
-            # They are the 'available' frequency bins we will shove stuff into.
-            # FX, FY turns our frequencies into a 2D grid for 2-dimensional 
-            # fourier transformation.
-            fx = np.linspace(-1/(2*dx),1/(2*dx),M)
-            fy = np.linspace(-1/(2*dy),1/(2*dy),N)
-            (FX,FY) = np.meshgrid(fx, fy);
-
-            # Fresnel transfer function
-            H = np.exp(-1j*np.pi*self.wavelength*distance*(np.square(FX) + np.square(FY)));
-
-            # Not sure why this 'fftshift' stuff is necessary.
-            H = np.fft.fftshift(H); # shift the transfer function in frequency
-            U1 = np.fft.fft2(np.fft.fftshift(self.complex_values))
-            U2 = H*U1; # Compute the fourier transform of our new field.
-
-            # update our complex values
-            self.complex_values = np.fft.ifftshift(np.fft.ifft2(U2)); # compute our final electromagnetic field
-            self.z += distance;
-
-            print(self.wavelength);
+            # of our phase function. If it is less than one, we need to switch to another
+            # propagator.
             oversampling_ratio = dx * self.Lx / self.wavelength / distance;
+
+            if(method == 'auto' and output_pitch is None):
+                (method, output_pitch) = choosePropagator(self.complex_values, dx, dy,
+                        self.wavelengthSamples(), distance, polychromatic=np.ndim(self.wavelengthSamples()) > 0);
+            elif(method == 'auto'):
+                method = 'scaled';
+            print(f"Propagating {self.ident} {distance}mm with the {method} propagator");
+
+            with profiling.stage('propagate', field=self.ident, method=method, distance=distance,
+                    shape=self.complex_values.shape):
+                if(method == 'scaled'):
+                    (out_dx, out_dy) = output_pitch if np.ndim(output_pitch) > 0 else (output_pitch, output_pitch);
+                    (self.complex_values, dx, dy) = scaledPropagate(self.complex_values, dx, dy,
+                            self.wavelengthSamples(), distance, out_dx, out_dy);
+                else:
+                    (self.complex_values, dx, dy) = PROPAGATORS[method](self.complex_values, dx, dy,
+                            self.wavelengthSamples(), distance, in_place=in_place);
+
+            self.Lx = N*dx;
+            self.Ly = M*dy;
+            self.z += distance;
             return oversampling_ratio;
         else:
             return 0;
 
+def gridCoordinates(L, N):
+    """
+    Returns the N sample coordinates across a window of size L, with a pitch of L/N and
+    the optical axis at index N//2, which is the convention all of our propagators use.
+    """
+    return (np.arange(N) - N//2) * (L/N);
+
 def circ(diameter, x,y):
     """
     Function that returns 1 if the coordinates x, y are within the radius of the circle
@@ -166,6 +261,12 @@ def rect(width, height, x, y):
     """
     return np.heaviside(width/2 - np.abs(x), 1)*np.heaviside(height/2 - np.abs(y), 1);
 
+def step(width, x):
+    """
+    Function that returns 1 if the 1D coordinates x are within the width (a 1D rect)
+    """
+    return np.heaviside(width/2 - np.abs(x), 1);
+
 def sq(width, x, y):
     """
     Function that returns 1 if the coordinates x, y are within the square
@@ -0,0 +1,98 @@
+# Thin wrappers around the FFT routines used by the propagators.
+# All of the propagation code goes through these functions rather than calling
+# numpy.fft directly, so that we have a single place to choose the FFT backend
+# and the number of threads used for each transform.
+#
+# If scipy is installed, we use scipy.fft. Its pocketfft backend keeps a cache of
+# FFT plans (twiddle factors and scratch workspaces) keyed by transform length, so
+# repeated transforms of the same grid do not re-plan, and it can split a transform
+# across several threads. Otherwise we fall back on numpy.fft, which gives the same
+# answer but always runs on a single core.
+#
+# All of the transforms keep the precision of their input: complex64 (or float32) in gives
+# complex64 out, so a single-precision simulation stays in single precision throughout.
+# With overwrite=True, scipy.fft writes a complex result straight into the input array
+# rather than allocating a new one, which is what the in-place propagation path relies on.
+
+import os
+import numpy as np
+from core import profiling
+
+try:
+    import scipy.fft as _fft_backend
+    HAS_SCIPY_FFT = True;
+except ImportError:
+    _fft_backend = np.fft;
+    HAS_SCIPY_FFT = False;
+
+# Number of threads used for each FFT. Can be overridden with the BDE_FFT_WORKERS
+# environment variable, or at runtime with setFFTWorkers.
+FFT_WORKERS = int(os.environ.get('BDE_FFT_WORKERS', os.cpu_count() or 1));
+
+def setFFTWorkers(workers):
+    """
+    Set the number of threads used for each FFT. -1 means use every available core.
+    """
+    global FFT_WORKERS
+    if(workers < 0):
+        workers = os.cpu_count() or 1;
+    FFT_WORKERS = max(1, int(workers));
+
+def countFFT(a):
+    """
+    Records the number and total size of the FFTs we do, when profiling is enabled.
+    """
+    if(profiling.active is not None):
+        profiling.active.count('fft');
+        profiling.active.count('fft_points', np.size(a));
+
+def keepPrecision(result, a):
+    """
+    Older versions of numpy.fft always return complex128, so cast single-precision
+    results back down.
+    """
+    if(np.asarray(a).dtype in (np.complex64, np.float32) and result.dtype != np.complex64):
+        return result.astype(np.complex64);
+    return result;
+
+def fft2(a, axes=(-2, -1), overwrite=False):
+    """
+    Two-dimensional forward FFT over the last two axes of a (or the given axes).
+    If a is a 3D stack, every 2D slice is transformed in a single call.
+    With overwrite=True the contents of a are destroyed, and may be reused for the result.
+    """
+    countFFT(a);
+    if(HAS_SCIPY_FFT):
+        return _fft_backend.fft2(a, axes=axes, overwrite_x=overwrite, workers=FFT_WORKERS);
+    else:
+        return keepPrecision(_fft_backend.fft2(a, axes=axes), a);
+
+def ifft2(a, axes=(-2, -1), overwrite=False):
+    """
+    Two-dimensional inverse FFT over the last two axes of a (or the given axes).
+    """
+    countFFT(a);
+    if(HAS_SCIPY_FFT):
+        return _fft_backend.ifft2(a, axes=axes, overwrite_x=overwrite, workers=FFT_WORKERS);
+    else:
+        return keepPrecision(_fft_backend.ifft2(a, axes=axes), a);
+
+def fft(a, n=None, axis=-1, overwrite=False):
+    """
+    One-dimensional forward FFT along the given axis, zero-padded to length n.
+    """
+    countFFT(a);
+    if(HAS_SCIPY_FFT):
+        return _fft_backend.fft(a, n=n, axis=axis, overwrite_x=overwrite, workers=FFT_WORKERS);
+    else:
+        return keepPrecision(_fft_backend.fft(a, n=n, axis=axis), a);
+
+def ifft(a, n=None, axis=-1, overwrite=False):
+    """
+    One-dimensional inverse FFT along the given axis.
+    """
+    countFFT(a);
+    if(HAS_SCIPY_FFT):
+        return _fft_backend.ifft(a, n=n, axis=axis, overwrite_x=overwrite, workers=FFT_WORKERS);
+    else:
+        return keepPrecision(_fft_backend.ifft(a, n=n, axis=axis), a);
@@ -0,0 +1,219 @@
+# Automatic choice of the simulation grid.
+#
+# Before we run anything, we look at every element in the netlist to figure out how big
+# the simulation window needs to be, and how finely we need to sample it so that we don't
+# alias anything. We then pick the smallest FFT-friendly number of points that satisfies
+# all of these criteria, since the FFTs are much faster on sizes with only small prime
+# factors (2, 3, 5).
+#
+# The criteria we use are:
+#   - The window should be WINDOW_FACTOR times larger than the largest source or aperture,
+#     so that the field (the majority of the intensity) fits within it.
+#   - Every source/aperture should be sampled with at least SAMPLES_PER_FEATURE points.
+#   - The quadratic phase of each lens must be sampled above the Nyquist rate out to the
+#     edge of the largest source/aperture D (outside of which the field is ~zero), which
+#     requires dx <= lambda*f / D.
+#   - After a hard-edged aperture, the Fresnel zones at the next plane, which have a
+#     size of about sqrt(lambda*z), should be sampled with at least 2 points each.
+#   - The correlation length of a random diffuser should be sampled with at least
+#     CORRELATION_SAMPLES points for every pi radians of its RMS phase, so that its
+#     (steeper, for stronger diffusers) phase gradients don't alias.
+#   - Every pixel of a mask loaded from an image or .npy file should be sampled at least
+#     IMAGE_PIXEL_SAMPLES times, so that none of its detail is lost in resampling.
+# If the netlist contains a '.grid <size> <N>' directive, it is used as-is.
+# The number of points is capped at MAX_POINTS, or OUT_OF_CORE_MAX_POINTS when the fields
+# are kept on disk rather than in memory (main.py --out-of-core).
+
+import numpy as np
+
+WINDOW_FACTOR = 3; # Window size relative to the largest source / aperture
+SAMPLES_PER_FEATURE = 10; # Minimum number of samples across the smallest source / aperture
+FRESNEL_ZONE_SAMPLES = 2; # Minimum number of samples across the first Fresnel zone
+CORRELATION_SAMPLES = 2; # Minimum number of samples per correlation length of a diffuser, per pi of RMS phase
+IMAGE_PIXEL_SAMPLES = 1; # Minimum number of samples per pixel of an image mask
+MIN_POINTS = 64;
+MAX_POINTS = 8192;
+OUT_OF_CORE_MAX_POINTS = 65536;
+
+# If there is nothing in the netlist with a finite size (e.g. just a plane wave and some
+# planes), we fall back on this window and number of points.
+DEFAULT_SIZE = 500;
+DEFAULT_POINTS = 200;
+
+def nextFastLength(n):
+    """
+    Returns the smallest number >= n of the form 2^a * 3^b * 5^c.
+    """
+    n = max(1, int(np.ceil(n)));
+    best = 2**int(np.ceil(np.log2(n)));
+    power_5 = 1;
+    while(power_5 < best):
+        power_35 = power_5;
+        while(power_35 < best):
+            candidate = power_35;
+            while(candidate < n):
+                candidate *= 2;
+            best = min(best, candidate);
+            power_35 *= 3;
+        power_5 *= 5;
+    return best;
+
+class GridPlan:
+    """
+    The simulation window size and number of points in x and y, along with the
+    reasoning behind them and predictions of the cost of running the simulation.
+    """
+    def __init__(self, size_x, size_y, N_x, N_y):
+        self.size_x = size_x;
+        self.size_y = size_y;
+        self.N_x = N_x;
+        self.N_y = N_y;
+        self.notes = [];
+        self.number_wavelengths = 1;
+        self.number_steps = 0;
+        self.steps = []; # (from, to, distance, oversampling ratio) for each propagation step
+
+    def memoryBytes(self):
+        """
+        Predicted peak memory of a propagation step: the field, its spectrum, the
+        transfer function, and a mask, for every wavelength.
+        """
+        return 4 * 16 * self.N_x * self.N_y * self.number_wavelengths;
+
+    def fftFlops(self):
+        """
+        Predicted number of floating point operations spent in FFTs for the whole run,
+        using the usual 5 N log2(N) estimate for a complex FFT of N points.
+        """
+        points = self.N_x * self.N_y;
+        per_fft = 5 * points * np.log2(points) * self.number_wavelengths;
+        return 2 * per_fft * self.number_steps;
+
+    def report(self):
+        lines = [f"Simulation grid: {self.size_x:g}mm x {self.size_y:g}mm, {self.N_x} x {self.N_y} points " +
+                f"(dx = {self.size_x/self.N_x:.4g}mm, dy = {self.size_y/self.N_y:.4g}mm)"];
+        lines += ["  " + note for note in self.notes];
+        for (start, stop, distance, oversampling_ratio) in self.steps:
+            warning = '' if oversampling_ratio >= 1 else ' (undersampled transfer function)';
+            lines.append(f"  {start} -> {stop}: {distance:g}mm, oversampling ratio {oversampling_ratio:.3g}{warning}");
+        lines.append(f"  Predicted memory per step: {self.memoryBytes()/2**20:.1f} MiB, " +
+                f"FFT cost: {self.fftFlops()/1e9:.3g} GFLOP over {self.number_steps} steps");
+        return '\n'.join(lines);
+
+def planGrid(masks, fields, directives={}, max_points=MAX_POINTS):
+    """
+    Chooses the simulation grid for the given masks and fields (as returned from
+    NetlistParser.parseNetlist) and the netlist directives, with at most max_points
+    points along each axis.
+    """
+    wavelengths = [field.wavelength for field in fields];
+    if('poly' in directives):
+        wavelengths = list(directives['poly']);
+    min_wavelength = min(wavelengths) if len(wavelengths) > 0 else 0;
+    max_wavelength = max(wavelengths) if len(wavelengths) > 0 else 0;
+
+    if('grid' in directives):
+        (size, N) = directives['grid'];
+        plan = GridPlan(size, size, N, N);
+        plan.notes.append("Grid set explicitly with .grid");
+    else:
+        plan = chooseGrid(masks, fields, min_wavelength, max_points);
+
+    plan.number_wavelengths = len(directives['poly']) if 'poly' in directives else 1;
+    plan.number_steps = len(fields) * len(masks);
+
+    # Report the oversampling ratio of the transfer-function propagator for every step,
+    # at the longest wavelength (the worst case). Elements inside a thick element are
+    # skipped, and the next step starts from its far face.
+    dx = plan.size_x / plan.N_x;
+    for field in fields:
+        z = field.z;
+        ident = field.ident;
+        for mask in masks:
+            if(mask.z < z):
+                continue;
+            distance = mask.z - z;
+            if(distance > 0 and max_wavelength > 0):
+                plan.steps.append((ident, mask.ident, distance, dx * plan.size_x / max_wavelength / distance));
+            z = mask.z + mask.thickness;
+            ident = mask.ident;
+
+    return plan;
+
+def chooseGrid(masks, fields, wavelength, max_points=MAX_POINTS):
+    """
+    Chooses the smallest window and FFT-friendly number of points that satisfy the
+    sampling criteria for every element.
+    """
+    widths = [];
+    heights = [];
+    notes = [];
+    for element in fields + masks:
+        if('waist' in element.parameters):
+            widths.append(2*element.parameters['waist']);
+            heights.append(2*element.parameters['waist']);
+        if('width' in element.parameters):
+            widths.append(element.parameters['width']);
+            heights.append(element.parameters['height']);
+
+    if(len(widths) == 0):
+        notes.append("No finite sources or apertures, using the default grid");
+        return withNotes(GridPlan(DEFAULT_SIZE, DEFAULT_SIZE, DEFAULT_POINTS, DEFAULT_POINTS), notes);
+
+    size_x = WINDOW_FACTOR * max(widths);
+    size_y = WINDOW_FACTOR * max(heights);
+    notes.append(f"Window is {WINDOW_FACTOR}x the largest source/aperture");
+
+    # Each constraint is a maximum pixel pitch, along with the reason for it.
+    constraints_x = [(min(widths) / SAMPLES_PER_FEATURE, "smallest source/aperture")];
+    constraints_y = [(min(heights) / SAMPLES_PER_FEATURE, "smallest source/aperture")];
+
+    for mask in masks:
+        if('focal_length' in mask.parameters and wavelength > 0):
+            focal_length = abs(mask.parameters['focal_length']);
+            constraints_x.append((wavelength * focal_length / max(widths), f"lens {mask.ident} phase"));
+            constraints_y.append((wavelength * focal_length / max(heights), f"lens {mask.ident} phase"));
+
+    # The phase of a random diffuser, whose gradient grows with its RMS phase
+    for mask in masks:
+        if('correlation_length' in mask.parameters):
+            pitch = mask.parameters['correlation_length'] / (CORRELATION_SAMPLES * max(1, mask.parameters['phase_std']/np.pi));
+            constraints_x.append((pitch, f"diffuser {mask.ident} correlation length"));
+            constraints_y.append((pitch, f"diffuser {mask.ident} correlation length"));
+
+    # The pixels of masks loaded from files
+    for mask in masks:
+        if('pixel_pitch' in mask.parameters):
+            (pitch_x, pitch_y) = mask.parameters['pixel_pitch'];
+            constraints_x.append((pitch_x / IMAGE_PIXEL_SAMPLES, f"pixels of image mask {mask.ident}"));
+            constraints_y.append((pitch_y / IMAGE_PIXEL_SAMPLES, f"pixels of image mask {mask.ident}"));
+
+    # The Fresnel zones right after each hard-edged aperture
+    for (i, mask) in enumerate(masks):
+        if('width' in mask.parameters and wavelength > 0):
+            following = [other.z - mask.z for other in masks[i+1:] if other.z > mask.z];
+            if(len(following) > 0):
+                zone = np.sqrt(wavelength * min(following)) / FRESNEL_ZONE_SAMPLES;
+                constraints_x.append((zone, f"Fresnel zones after {mask.ident}"));
+                constraints_y.append((zone, f"Fresnel zones after {mask.ident}"));
+
+    (N_x, reason_x) = pointsFor(size_x, constraints_x, max_points);
+    (N_y, reason_y) = pointsFor(size_y, constraints_y, max_points);
+    notes.append(f"Sampling in x is set by the {reason_x}, in y by the {reason_y}");
+    if(N_x == max_points or N_y == max_points):
+        notes.append(f"WARNING: Grid capped at {max_points} points, the field may alias");
+
+    return withNotes(GridPlan(size_x, size_y, N_x, N_y), notes);
+
+def pointsFor(size, constraints, max_points=MAX_POINTS):
+    """
+    Returns the number of points required to satisfy the tightest of the pixel
+    pitch constraints, and the reason for that constraint.
+    """
+    (pitch, reason) = min(constraints, key=lambda c: c[0]);
+    N = min(max_points, max(MIN_POINTS, nextFastLength(size / pitch)));
+    return (N, reason);
+
+def withNotes(plan, notes):
+    plan.notes += notes;
+    return plan;
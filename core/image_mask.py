@@ -0,0 +1,144 @@
+# Masks sampled from data rather than from an analytic function: a photo, a lithography
+# mask or an SLM pattern, loaded from an image file (png, jpg, tif, ...) or a .npy array.
+#
+# The data covers a physical width x height centered on the optical axis, with its first
+# row at -height/2 (the top of the plots, as for every other field and mask) and its first
+# column at -width/2. It is one of:
+#   amplitude  the amplitude transmission. Outside the data, the mask is opaque.
+#   phase      the phase in radians (.npy), or from 0 to 2 pi over the range of the
+#              image's gray levels. Outside the data, the mask is transparent.
+#   complex    the complex transmission (.npy only). Outside the data, it is opaque.
+# Color images are converted to their luminance, and integer images scaled to [0, 1].
+#
+# .npy files are memory-mapped, so a mask much larger than the simulation grid is never
+# read in whole: it is resampled onto the grid (with nearest-neighbour or bilinear
+# interpolation) a strip of rows at a time, reading only the rows of the file the strip
+# needs. Images have to be decoded, so for masks of hundreds of megabytes, use a .npy file.
+# Either way, the data of each file is only loaded once per process (and again only if the
+# file changes), and the resampled values are cached per grid by Mask.evaluate. Since the
+# masks themselves are shared between every source and .step variant with the same
+# definition (core/scheduler.py), neither is repeated for them.
+
+import os
+from collections import OrderedDict
+import numpy as np
+from core.fields import Mask
+
+MASK_KINDS = ('amplitude', 'phase', 'complex');
+INTERPOLATIONS = ('nearest', 'linear');
+IMAGE_STRIP_BYTES = 64*2**20; # Rough upper bound on the size of the strips we resample at once
+MAX_CACHED_FILES = 4;
+LUMINANCE = np.array([0.299, 0.587, 0.114]); # Weights of red, green and blue in a gray level
+
+mask_data_cache = OrderedDict(); # The data of recently used files, keyed by path, size and modification time
+
+def loadMaskData(path):
+    """
+    Returns the 2D array of data in a mask file, memory-mapped if it is a .npy file, or
+    decoded into gray levels in [0, 1] if it is an image.
+    """
+    status = os.stat(path);
+    key = (os.path.abspath(path), status.st_size, status.st_mtime_ns);
+    if(key in mask_data_cache):
+        mask_data_cache.move_to_end(key);
+        return mask_data_cache[key];
+
+    if(path.lower().endswith('.npy')):
+        data = np.load(path, mmap_mode='r');
+    else:
+        # matplotlib is only imported when we actually load an image, like for plotting
+        import matplotlib.image
+        data = matplotlib.image.imread(path);
+        if(np.issubdtype(data.dtype, np.integer)):
+            data = data / np.iinfo(data.dtype).max;
+        if(data.ndim == 3): # Color, perhaps with an alpha channel
+            data = data[..., :3] @ LUMINANCE if data.shape[2] >= 3 else data[..., 0];
+        data = np.ascontiguousarray(data, dtype=float);
+    if(data.ndim != 2):
+        raise ValueError(f"Mask data in {path} has shape {data.shape}, not (rows, columns)");
+
+    mask_data_cache[key] = data;
+    if(len(mask_data_cache) > MAX_CACHED_FILES):
+        mask_data_cache.popitem(last=False);
+    return data;
+
+def interpolationWeights(u, n, interpolation):
+    """
+    Returns a list of (indices, weights) pairs into n samples, for the fractional sample
+    positions u, whose weighted sum interpolates the samples at u.
+    """
+    if(interpolation == 'nearest' or n == 1):
+        return [(np.clip(np.rint(u), 0, n - 1).astype(np.intp), 1)];
+    lower = np.clip(np.floor(u), 0, n - 2).astype(np.intp);
+    fraction = np.clip(u - lower, 0, 1);
+    return [(lower, 1 - fraction), (lower + 1, fraction)];
+
+class ImageMask(Mask):
+    """
+    A mask of the given kind, sampled from the data in the file at path, which covers
+    width x height (in mm).
+    """
+    def __init__(self, ident, location, path, width, height, kind=None, interpolation='linear'):
+        super().__init__(ident, location);
+        self.is_passive_plane = False;
+        self.wavelength_independent = True;
+        self.path = path;
+        self.files = (path,);
+        self.width = width;
+        self.height = height;
+        self.interpolation = interpolation;
+        data = loadMaskData(path);
+        is_complex = np.iscomplexobj(data);
+        self.kind = kind if kind is not None else ('complex' if is_complex else 'amplitude');
+        if(is_complex != (self.kind == 'complex')):
+            raise ValueError(f"A {self.kind} mask needs {'complex' if self.kind == 'complex' else 'real'} data, " +
+                    f"but {path} holds {data.dtype} values");
+        # Images hold gray levels rather than radians
+        self.phase_scale = 1 if path.lower().endswith('.npy') else 2*np.pi;
+        (rows, columns) = data.shape;
+        self.parameters = {'width': width, 'height': height, 'pixel_pitch': (width/columns, height/rows)};
+
+    @property
+    def data(self):
+        return loadMaskData(self.path);
+
+    def sample(self, x, y, l, dtype=np.complex128):
+        """
+        Resamples the data onto the grid with 1D coordinate vectors x and y, a strip of
+        rows at a time, reading only the rows of the data that each strip needs.
+        """
+        data = self.data;
+        (rows, columns) = data.shape;
+        inside_x = np.abs(x) <= self.width/2;
+        inside_y = np.abs(y) <= self.height/2;
+        columns_needed = interpolationWeights((x + self.width/2) / self.width * columns - 0.5, columns,
+                self.interpolation);
+        v = (y + self.height/2) / self.height * rows - 0.5;
+        outside = 1 if self.kind == 'phase' else 0;
+
+        values = np.empty((y.size, x.size), dtype=dtype);
+        # The strip of the data (up to two rows of it per row of the grid), and the block resampled from it
+        strip_rows = max(1, IMAGE_STRIP_BYTES // (16 * (2*columns + 2*x.size)));
+        for start in range(0, y.size, strip_rows):
+            stop = min(start + strip_rows, y.size);
+            rows_needed = interpolationWeights(v[start:stop], rows, self.interpolation);
+            # Read each row of the data this strip needs just once, in order
+            (unique_rows, positions) = np.unique(np.concatenate([indices for (indices, _) in rows_needed]),
+                    return_inverse=True);
+            strip_data = np.asarray(data[unique_rows]);
+            block = 0;
+            offset = 0;
+            for (row_indices, row_weights) in rows_needed:
+                row_positions = positions[offset:offset + row_indices.size];
+                offset += row_indices.size;
+                for (column_indices, column_weights) in columns_needed:
+                    block = block + (strip_data[np.ix_(row_positions, column_indices)] *
+                            np.multiply.outer(np.broadcast_to(row_weights, row_indices.shape),
+                            np.broadcast_to(column_weights, column_indices.shape)));
+            if(self.kind == 'phase'):
+                block = np.exp(1j * self.phase_scale * block);
+            strip = values[start:stop];
+            strip[...] = block;
+            strip[:, ~inside_x] = outside;
+            strip[~inside_y[start:stop], :] = outside;
+        return values;
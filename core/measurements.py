@@ -0,0 +1,139 @@
+# Observables measured on the fly, for runs that only need a few numbers at each plane
+# rather than the whole field.
+#
+# Each '.measure <name> <observable> [<parameter>] [at=<element>]' directive asks for one
+# observable at every plane the field is saved at (or only at the given elements):
+#   power                  total power, the integral of the intensity
+#   peak                   peak intensity
+#   centroid               intensity-weighted mean position (columns <name>_x, <name>_y)
+#   width                  second-moment beam radius 2*sigma in x and y, which is the 1/e^2
+#                          radius for a Gaussian beam (columns <name>_x, <name>_y)
+#   encircled <radius>     fraction of the power within radius of the optical axis
+#   overlap <waist>        coupling efficiency into a Gaussian mode exp(-r^2/waist^2) on the
+#                          optical axis, |<mode|U>|^2 / (<U|U> <mode|mode>)
+# Polychromatic intensities are summed over the spectrum with its spectral weights, and the
+# overlap is the fraction of the total power coupled.
+#
+# Every observable is a sum (or maximum) over the pixels, so they are all accumulated in
+# a single pass over the field, a strip of rows at a time. That keeps the temporary arrays
+# small, and works just the same for out-of-core fields, which are never read in whole.
+# The results are kept in the result store's index (see core/result_store.py), and
+# written out as a CSV table at the end of the run.
+
+import csv
+import numpy as np
+
+MEASURE_STRIP_BYTES = 64*2**20; # Rough upper bound on the size of the strips we measure at once
+
+OBSERVABLES = {
+    # observable: (takes a parameter, column suffixes)
+    'power': (False, ['']),
+    'peak': (False, ['']),
+    'centroid': (False, ['_x', '_y']),
+    'width': (False, ['_x', '_y']),
+    'encircled': (True, ['']),
+    'overlap': (True, ['']),
+};
+
+class Measure:
+    """
+    One observable asked for with .measure. parameter is the radius (encircled) or the
+    waist (overlap) in mm, and planes are the elements to measure it at (None for all).
+    """
+    def __init__(self, name, observable, parameter=None, planes=None):
+        self.name = name;
+        self.observable = observable;
+        self.parameter = parameter;
+        self.planes = planes;
+
+    def columns(self):
+        return [self.name + suffix for suffix in OBSERVABLES[self.observable][1]];
+
+    def appliesTo(self, plane):
+        return self.planes is None or plane in self.planes;
+
+def measureField(field, measures, plane):
+    """
+    Returns a dictionary of the value of every column of the measures that apply at plane,
+    for the current values of field.
+    """
+    measures = [measure for measure in measures if measure.appliesTo(plane)];
+    values = field.complex_values;
+    (M, N) = values.shape[-2:];
+    (dx, dy) = (field.Lx/N, field.Ly/M);
+    x = (np.arange(N) - N//2) * dx;
+    y = (np.arange(M) - M//2) * dy;
+    weights = field.weights if np.ndim(field.wavelengthSamples()) > 0 else None;
+    radii = set(measure.parameter for measure in measures if measure.observable == 'encircled');
+    waists = set(measure.parameter for measure in measures if measure.observable == 'overlap');
+
+    sums = dict.fromkeys(['power', 'x', 'y', 'xx', 'yy'], 0);
+    peak = 0;
+    plane_power = 0; # The power in each wavelength, for the overlaps
+    encircled = dict.fromkeys(radii, 0);
+    projections = dict.fromkeys(waists, 0);
+    rows = max(1, MEASURE_STRIP_BYTES // (N * values.itemsize * int(np.prod(values.shape[:-2]))));
+    for start in range(0, M, rows):
+        block = np.asarray(values[..., start:start + rows, :]);
+        y_block = y[start:start + rows, None];
+        spectral = np.square(np.abs(block));
+        intensity = spectral if weights is None else np.tensordot(weights, spectral, axes=1);
+        row_sums = intensity.sum(axis=1); # Summed over x, for the moments in y
+        column_sums = intensity.sum(axis=0);
+        sums['power'] += row_sums.sum();
+        sums['x'] += column_sums @ x;
+        sums['xx'] += column_sums @ np.square(x);
+        sums['y'] += row_sums @ y_block[:, 0];
+        sums['yy'] += row_sums @ np.square(y_block[:, 0]);
+        peak = max(peak, intensity.max(initial=0));
+        if(len(radii) > 0):
+            r_squared = np.square(x) + np.square(y_block);
+            for radius in radii:
+                encircled[radius] += intensity[r_squared <= radius*radius].sum();
+        if(len(waists) > 0):
+            plane_power = plane_power + spectral.sum(axis=(-2, -1));
+            for waist in waists:
+                mode = np.outer(np.exp(-np.square(y_block[:, 0])/waist**2), np.exp(-np.square(x)/waist**2));
+                projections[waist] = projections[waist] + (block * mode).sum(axis=(-2, -1));
+
+    total = sums['power'];
+    mean_x = sums['x'] / total if total > 0 else 0;
+    mean_y = sums['y'] / total if total > 0 else 0;
+    results = {};
+    for measure in measures:
+        if(measure.observable == 'power'):
+            value = [total * dx * dy];
+        elif(measure.observable == 'peak'):
+            value = [peak];
+        elif(measure.observable == 'centroid'):
+            value = [mean_x, mean_y];
+        elif(measure.observable == 'width'):
+            value = [2*np.sqrt(max(0, sums['xx']/total - mean_x**2)) if total > 0 else 0,
+                    2*np.sqrt(max(0, sums['yy']/total - mean_y**2)) if total > 0 else 0];
+        elif(measure.observable == 'encircled'):
+            value = [encircled[measure.parameter] / total if total > 0 else 0];
+        else: # overlap
+            waist = measure.parameter;
+            mode_power = np.sum(np.exp(-2*np.square(x)/waist**2)) * np.sum(np.exp(-2*np.square(y)/waist**2));
+            coupled = np.square(np.abs(projections[waist])) / mode_power;
+            if(weights is not None):
+                (coupled, power) = (weights @ coupled, weights @ plane_power);
+            else:
+                power = plane_power;
+            value = [float(coupled / power) if power > 0 else 0];
+        results.update(zip(measure.columns(), [float(v) for v in value]));
+    return results;
+
+def writeMeasurements(filename, measurements, measures):
+    """
+    Writes the measurements (a list of dictionaries, one per saved plane) to a CSV file,
+    with a column for each measure and blanks where it wasn't measured.
+    """
+    keys = ['variant', 'field', 'plane', 'stage', 'z'];
+    keys = [key for key in keys if any(key in row for row in measurements)];
+    columns = [column for measure in measures for column in measure.columns()];
+    with open(filename, 'w', newline='') as table_file:
+        writer = csv.DictWriter(table_file, fieldnames=keys + columns, extrasaction='ignore');
+        writer.writeheader();
+        for row in measurements:
+            writer.writerow({key: (f"{value:.10g}" if isinstance(value, float) else value) for (key, value) in row.items()});
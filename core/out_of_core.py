@@ -0,0 +1,185 @@
+# Out-of-core simulation, for grids too large to fit in memory.
+#
+# Rather than holding the field as a single in-memory array, an out-of-core field keeps
+# its complex values in a memory-mapped .npy file in a scratch directory, and everything
+# we do to it is done a strip at a time, so that only about STRIP_BYTES of the field is in
+# memory at once. That makes the size of the grid limited by disk space rather than RAM.
+#
+#   sampling:    The source is evaluated from its analytic amplitude/phase functions one
+#                strip of rows at a time, straight into the file.
+#   masks:       Likewise, each mask is evaluated on a strip of rows and multiplied into
+#                the field, without ever building the whole mask.
+#   propagation: The 2D FFT is split into its 1D row and column transforms. One pass over
+#                strips of rows does the FFT along x. A pass over strips of columns then
+#                does the FFT along y, applies the transfer function (which is separable,
+#                so each tile is just the product of two 1D factors) and the inverse FFT
+#                along y. A final pass over the rows does the inverse FFT along x. As in the
+#                in-memory propagators, no fftshifts are needed (see core/propagators.py).
+#
+# Only the transfer and impulse propagators are supported out of core, since they keep the
+# same grid, and thick elements and random masks (whose screens can't be generated a
+# strip at a time) aren't supported. Polychromatic (wavelength, y, x) stacks
+# work just like single planes.
+
+import os
+import shutil
+import numpy as np
+from core.fourier import fft, ifft
+from core.fields import gridCoordinates
+from core.transfer_functions import fresnelFactors, impulseResponseFactors
+from core.simulation import saveAndPlot
+from core import profiling
+
+STRIP_BYTES = 256*2**20; # Rough upper bound on the memory used by a single strip
+
+FACTORS = {
+    'transfer': fresnelFactors,
+    'impulse': impulseResponseFactors,
+};
+
+def stripWidth(values, length, strip_bytes=STRIP_BYTES):
+    """
+    Returns how many rows (or columns) of values, each with length samples, fit in a strip.
+    """
+    planes = int(np.prod(values.shape[:-2]));
+    return max(1, strip_bytes // (planes * length * values.dtype.itemsize));
+
+def strips(size, width):
+    """
+    Yields the (start, stop) indices of each strip when splitting size rows or columns
+    into strips of width.
+    """
+    for start in range(0, size, width):
+        yield (start, min(start + width, size));
+
+def createValues(field, shape, scratch_directory, label=''):
+    """
+    Creates the memory-mapped file holding the values of field, with the given shape.
+    """
+    filename = os.path.join(scratch_directory, field.ident + label + '.npy');
+    return np.lib.format.open_memmap(filename, mode='w+', dtype=field.dtype, shape=shape);
+
+def removeValues(values):
+    values.flush();
+    os.remove(values.filename);
+
+def sampleSource(field, x, y, values, strip_bytes=STRIP_BYTES):
+    """
+    Evaluates the source field on the grid with 1D coordinate vectors x and y, a strip
+    of rows at a time, writing the result into values.
+    """
+    rows = stripWidth(values, x.size, strip_bytes);
+    for (start, stop) in strips(y.size, rows):
+        (x_grid, y_grid) = np.meshgrid(x, y[start:stop]);
+        values[..., start:stop, :] = field.complexFunction(x_grid, y_grid, field.wavelengthGrid());
+    values.flush();
+
+def applyMask(values, mask, x, y, l, strip_bytes=STRIP_BYTES):
+    """
+    Multiplies values by the mask, evaluating the mask a strip of rows at a time.
+    """
+    rows = stripWidth(values, x.size, strip_bytes);
+    for (start, stop) in strips(y.size, rows):
+        block = np.array(values[..., start:stop, :]);
+        block *= mask.sample(x, y[start:stop], l, values.dtype);
+        values[..., start:stop, :] = block;
+    values.flush();
+
+def propagateValues(values, dx, dy, wavelength, distance, method, strip_bytes=STRIP_BYTES):
+    """
+    Propagates the (memory-mapped) values in place, using the row/column decomposition
+    of the 2D FFT described at the top of this file.
+    """
+    (M, N) = values.shape[-2:];
+    (Hy, Hx) = FACTORS[method]((M, N), dx, dy, wavelength, distance, values.dtype);
+
+    rows = stripWidth(values, N, strip_bytes);
+    for (start, stop) in strips(M, rows):
+        block = np.array(values[..., start:stop, :]);
+        values[..., start:stop, :] = fft(block, axis=-1, overwrite=True);
+
+    columns = stripWidth(values, M, strip_bytes);
+    for (start, stop) in strips(N, columns):
+        block = fft(np.array(values[..., :, start:stop]), axis=-2, overwrite=True);
+        block *= Hy[..., :, None];
+        block *= Hx[..., None, start:stop];
+        values[..., :, start:stop] = ifft(block, axis=-2, overwrite=True);
+
+    for (start, stop) in strips(M, rows):
+        block = np.array(values[..., start:stop, :]);
+        values[..., start:stop, :] = ifft(block, axis=-1, overwrite=True);
+    values.flush();
+
+def propagateOutOfCore(field, distance, strip_bytes=STRIP_BYTES):
+    """
+    Propagates an out-of-core field by distance, using the transfer function propagator
+    if it is well-sampled, and the impulse response propagator otherwise.
+    Returns the oversampling ratio of the transfer function.
+    """
+    if(distance <= 0):
+        return 0;
+    (M, N) = field.complex_values.shape[-2:];
+    dx = field.Lx/N;
+    dy = field.Ly/M;
+    wavelength = field.wavelengthSamples();
+    oversampling_ratio = min(dx*field.Lx, dy*field.Ly) / np.max(wavelength) / distance;
+    method = 'transfer' if oversampling_ratio >= 1 else 'impulse';
+    print(f"Propagating {field.ident} {distance}mm out of core with the {method} propagator");
+    with profiling.stage('propagate', field=field.ident, method=method, distance=distance,
+            shape=field.complex_values.shape, out_of_core=True):
+        propagateValues(field.complex_values, dx, dy, wavelength, distance, method, strip_bytes);
+    field.z += distance;
+    return oversampling_ratio;
+
+def checkDiskSpace(plan, fields, scratch_directory):
+    """
+    Returns the number of bytes of scratch space needed for a single field, after warning
+    if there isn't that much free space in scratch_directory.
+    """
+    planes = max([np.size(field.wavelengthSamples()) for field in fields] + [1]);
+    needed = plan.N_x * plan.N_y * planes * np.dtype(fields[0].dtype).itemsize if len(fields) > 0 else 0;
+    free = shutil.disk_usage(scratch_directory).free;
+    if(needed > free):
+        print(f"WARNING: Each field needs {needed/2**30:.2f} GiB of scratch space, but only " +
+                f"{free/2**30:.2f} GiB is free in {scratch_directory}");
+    return needed;
+
+def simulateOutOfCore(field, masks, plan, store, renderer, scratch_directory, label=''):
+    """
+    The out-of-core equivalent of core.simulation.simulateField: samples the source field
+    into a memory-mapped file, and propagates it to each plane and mask in turn, saving the
+    field to the store before and after every mask. The file is removed at the end.
+    """
+    print(f"Beginning out-of-core simulation with wavelength {field.wavelength}");
+    x = gridCoordinates(plan.size_x, plan.N_x);
+    y = gridCoordinates(plan.size_y, plan.N_y);
+    field.Lx = plan.size_x;
+    field.Ly = plan.size_y;
+    shape = np.shape(field.wavelengthSamples()) + (plan.N_y, plan.N_x);
+
+    with profiling.stage('field', field=field.ident, out_of_core=True):
+        field.complex_values = createValues(field, shape, scratch_directory, label);
+        with profiling.stage('source', field=field.ident):
+            sampleSource(field, x, y, field.complex_values);
+
+        for mask in masks:
+            delta_distance = mask.z - field.z;
+            OR = propagateOutOfCore(field, delta_distance);
+            saveAndPlot(field, mask.ident, 'pre_mask', store, renderer);
+            print(f"Oversampling Ratio: {OR}");
+
+            mask.Lx = field.Lx;
+            mask.Ly = field.Ly;
+            if(mask.thickness > 0):
+                print(f"ERROR: Thick element {mask.ident} is not supported out of core, ignoring it.");
+            elif(mask.is_random):
+                print(f"ERROR: Random mask {mask.ident} is not supported out of core, ignoring it.");
+            elif(not mask.is_passive_plane):
+                with profiling.stage('apply_mask', field=field.ident, mask=mask.ident):
+                    applyMask(field.complex_values, mask, x, y, field.wavelengthGrid());
+                saveAndPlot(field, mask.ident, 'post_mask', store, renderer);
+
+    store.flush();
+    values = field.complex_values;
+    field.complex_values = np.array([]);
+    removeValues(values);
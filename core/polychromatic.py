@@ -0,0 +1,80 @@
+# Polychromatic (broadband) fields.
+#
+# Rather than creating one Field per spectral sample and looping over them in python,
+# a PolychromaticField stores the whole spectrum as a single (wavelength, y, x) array.
+# Sources and masks are evaluated for every wavelength at once by passing the
+# wavelengths as an (L, 1, 1) column to the amplitude/phase functions, which then
+# broadcast against the (y, x) grid. The transfer functions for every wavelength are
+# built as one stack, and the whole stack is propagated with a single batched fft2
+# over the last two axes.
+
+import numpy as np
+from core.fields import Field
+
+class PolychromaticField(Field):
+    """
+    A field carrying a discrete spectrum of wavelengths, with spectral weights
+    used when summing the intensity incoherently across the spectrum.
+    """
+    def __init__(self, field, wavelengths, weights=None):
+        wavelengths = np.asarray(wavelengths, dtype=float);
+        # The 'wavelength' of a polychromatic field is taken to be the central wavelength,
+        # which is what gets reported when we print out the simulation progress.
+        super().__init__(field.ident, field.z, np.mean(wavelengths),
+                field.phaseFunction, field.amplitudeFunction);
+        self.wavelengths = wavelengths;
+        self.definition = field.definition;
+        if(weights is None):
+            weights = np.ones(wavelengths.shape);
+        self.weights = np.asarray(weights, dtype=float);
+
+    wavelengths = np.array([]); # The wavelengths in our spectrum, 1D array
+    weights = np.array([]); # The spectral weight (power) of each wavelength
+
+    def wavelengthSamples(self):
+        return self.wavelengths;
+
+    def wavelengthGrid(self):
+        return self.wavelengths[:, None, None];
+
+    def complexFunction(self, x, y, l):
+        """
+        Evaluates the source for every wavelength, always returning a full
+        (wavelength, y, x) stack even if the source does not depend on the wavelength.
+        """
+        values = Field.complexFunction(self, x, y, l);
+        if(values is None):
+            return None;
+        stack_shape = (self.wavelengths.size,) + np.shape(x)[-2:];
+        return np.broadcast_to(values, stack_shape).astype(complex);
+
+    def intensity(self):
+        """
+        Returns the incoherent sum of the intensity over the spectrum, weighted by
+        the spectral weights.
+        """
+        spectral_intensity = np.square(np.abs(self.complex_values));
+        return np.tensordot(self.weights, spectral_intensity, axes=1);
+
+    def saveValues(self, filename):
+        """
+        Saves the incoherently-summed intensity to a file with filename "filename".
+        """
+        np.savetxt(filename, self.intensity());
+
+    def plotMagPhase(self, title=''):
+        """
+        Plots the incoherently-summed intensity. The phase is not well-defined for
+        a polychromatic field, so we don't plot it.
+        """
+        import matplotlib.pyplot as plt
+        fig, ax = plt.subplots(figsize=(7,7))
+        ax.set_xlabel('x(mm)')
+        ax.set_ylabel('y(mm)')
+        ax.set_title('Intensity');
+        extent = None;
+        if(self.Lx != 0 and self.Ly != 0):
+            extent = [-self.Lx/2,self.Lx/2,-self.Ly/2,self.Ly/2];
+        amp = ax.imshow(self.intensity(), extent=extent);
+        fig.colorbar(amp, ax=ax)
+        fig.suptitle(title);
@@ -0,0 +1,162 @@
+# Per-stage profiling of a simulation.
+#
+# Profiling is off by default, and costs (almost) nothing when it is off: every
+# instrumented piece of code does
+#       with profiling.stage('propagate', field=...):
+# which just returns a shared do-nothing context manager unless profiling is enabled.
+# Turn it on with 'python3 main.py --profile', or by setting the environment variable
+# BDE_PROFILE=1.
+#
+# When it is on, every stage records its wall time, the bytes allocated (using tracemalloc,
+# which numpy reports its array allocations to), and any counters incremented while it was
+# running (e.g. the number and size of FFTs, and transfer function cache hits). At the end
+# of the run we print a summary table, and write a trace which can be opened in Chrome
+# (chrome://tracing) or Perfetto.
+
+import json
+import os
+import time
+import tracemalloc
+
+class NullStage:
+    """
+    The do-nothing stage we hand out when profiling is disabled.
+    """
+    def __enter__(self):
+        return self;
+
+    def __exit__(self, *exception):
+        return False;
+
+NULL_STAGE = NullStage();
+
+class Stage:
+    def __init__(self, profiler, name, details):
+        self.profiler = profiler;
+        self.name = name;
+        self.details = details;
+        self.counters = {};
+        self.child_peak = 0;
+
+    def __enter__(self):
+        self.profiler.stack.append(self);
+        self.start_memory = tracemalloc.get_traced_memory()[0];
+        tracemalloc.reset_peak();
+        self.start = time.perf_counter();
+        return self;
+
+    def __exit__(self, *exception):
+        end = time.perf_counter();
+        (memory, peak) = tracemalloc.get_traced_memory();
+        peak = max(peak, self.child_peak);
+        self.profiler.stack.pop();
+        if(len(self.profiler.stack) > 0):
+            parent = self.profiler.stack[-1];
+            parent.child_peak = max(parent.child_peak, peak);
+            for (counter, value) in self.counters.items(): # Counters roll up into the parent
+                parent.counters[counter] = parent.counters.get(counter, 0) + value;
+        self.profiler.record(self, self.start, end, memory - self.start_memory, peak - self.start_memory);
+        return False;
+
+class Profiler:
+    def __init__(self):
+        self.stack = [];
+        self.events = [];
+        self.origin = time.perf_counter();
+        if(not tracemalloc.is_tracing()):
+            tracemalloc.start();
+
+    def stage(self, name, **details):
+        return Stage(self, name, details);
+
+    def count(self, counter, amount=1):
+        """
+        Increments a counter in the innermost running stage.
+        """
+        if(len(self.stack) > 0):
+            counters = self.stack[-1].counters;
+            counters[counter] = counters.get(counter, 0) + amount;
+
+    def record(self, stage, start, end, allocated, peak):
+        self.events.append({'name': stage.name, 'start': start - self.origin, 'duration': end - start,
+                'allocated': allocated, 'peak': peak, 'depth': len(self.stack), 'pid': os.getpid(),
+                'details': stage.details, 'counters': dict(stage.counters)});
+
+    def merge(self, events):
+        """
+        Adds events recorded by another process (e.g. a worker) to this profile.
+        """
+        self.events += events;
+
+    def summary(self):
+        """
+        Returns a table of the total time, allocations and counters for each stage, followed
+        by the cache hits for each mask and field.
+        """
+        totals = {};
+        for event in self.events:
+            total = totals.setdefault(event['name'], {'calls': 0, 'time': 0, 'allocated': 0, 'peak': 0, 'counters': {}});
+            total['calls'] += 1;
+            total['time'] += event['duration'];
+            total['allocated'] += max(0, event['allocated']);
+            total['peak'] = max(total['peak'], event['peak']);
+            for (counter, value) in event['counters'].items():
+                total['counters'][counter] = total['counters'].get(counter, 0) + value;
+
+        lines = [f"{'Stage':14s} {'Calls':>7s} {'Time (s)':>10s} {'Allocated (MiB)':>16s} {'Peak (MiB)':>11s}  Counters"];
+        for (name, total) in sorted(totals.items(), key=lambda item: -item[1]['time']):
+            counters = ', '.join(f"{counter}={value:g}" for (counter, value) in sorted(total['counters'].items()));
+            lines.append(f"{name:14s} {total['calls']:7d} {total['time']:10.4f} {total['allocated']/2**20:16.1f} " +
+                    f"{total['peak']/2**20:11.1f}  {counters}");
+
+        cache = {};
+        for event in self.events:
+            if('cache' in event['details']):
+                owner = event['details'].get('mask', event['details'].get('field', ''));
+                (hits, misses) = cache.get(owner, (0, 0));
+                hit = event['details']['cache'] == 'hit';
+                cache[owner] = (hits + hit, misses + (not hit));
+        if(len(cache) > 0):
+            lines.append("Cache hits/misses: " + ', '.join(f"{owner} {hits}/{misses}"
+                    for (owner, (hits, misses)) in sorted(cache.items())));
+        return '\n'.join(lines);
+
+    def writeChromeTrace(self, filename):
+        """
+        Writes the recorded stages as a Chrome trace event file.
+        """
+        trace = [];
+        for event in self.events:
+            arguments = dict(event['details']);
+            arguments.update(event['counters']);
+            arguments.update({'allocated_bytes': event['allocated'], 'peak_bytes': event['peak']});
+            trace.append({'name': event['name'], 'ph': 'X', 'ts': event['start']*1e6, 'dur': event['duration']*1e6,
+                    'pid': event['pid'], 'tid': 0, 'args': {key: jsonable(value) for (key, value) in arguments.items()}});
+        with open(filename, 'w') as trace_file:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, trace_file);
+
+def jsonable(value):
+    if(isinstance(value, (str, int, float, bool)) or value is None):
+        return value;
+    return str(value);
+
+# The profiler for this process, or None if profiling is disabled.
+active = None;
+
+def enable():
+    global active
+    if(active is None):
+        active = Profiler();
+    return active;
+
+def stage(name, **details):
+    if(active is None):
+        return NULL_STAGE;
+    return active.stage(name, **details);
+
+def count(counter, amount=1):
+    if(active is not None):
+        active.count(counter, amount);
+
+if(os.environ.get('BDE_PROFILE', '') not in ('', '0')):
+    enable();
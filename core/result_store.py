@@ -0,0 +1,153 @@
+# Binary storage for the results of a simulation.
+#
+# All the planes saved during a run go into a single raw binary file, one after another,
+# alongside a small JSON index describing each plane (which field and mask it belongs to,
+# its location, wavelength(s), window size, and where it lives in the binary file).
+# Because the planes are stored raw, a reader can memory-map any one of them without
+# reading the rest of the file, which is much faster (and several times smaller) than
+# writing each plane out as text.
+#
+# The store for a run called 'output/my_run.bde' consists of:
+#   output/my_run.bde       the raw plane data
+#   output/my_run.bde.json  the index
+# Rewriting the index after every plane would make long runs quadratic, so the index is
+# only written when the store is flushed: after each field is done, and when the store
+# is closed at the end of the run. If a run crashes, the index still describes every
+# field finished before the crash.
+#
+# If the netlist asks for measurements (.measure, see core/measurements.py), they are taken
+# every time a field is written to the store, and kept in the index alongside the planes.
+# With save_fields=False, only the measurements are kept, and no planes are written at all.
+
+import json
+import os
+import numpy as np
+from core.measurements import measureField
+from core import profiling
+
+# Planes are written out this many bytes at a time, so that a plane which lives on disk
+# (e.g. an out-of-core field) never has to be read into memory all at once.
+WRITE_CHUNK_BYTES = 64*2**20;
+
+class ResultStore:
+    """
+    A collection of complex-valued planes stored in a single binary file.
+    Use ResultStore(path) to create a new store, and ResultStore.open(path) to read one.
+    """
+    def __init__(self, path, dtype=np.complex128, mode='w', measures=(), save_fields=True):
+        self.path = path;
+        self.index_path = path + '.json';
+        self.dtype = np.dtype(dtype);
+        self.mode = mode;
+        self.planes = [];
+        self.measures = list(measures);
+        self.measurements = []; # One dictionary of observables per field written to the store
+        self.save_fields = save_fields;
+        self.index_changed = False; # True if the index has changed since it was last written
+        if(mode == 'w'):
+            directory = os.path.dirname(path);
+            if(directory != ''):
+                os.makedirs(directory, exist_ok=True);
+            open(self.path, 'wb').close();
+            self.writeIndex();
+
+    @classmethod
+    def open(cls, path):
+        """
+        Opens an existing store for reading. None of the plane data is read until asked for.
+        """
+        store = cls(path, mode='r');
+        with open(store.index_path, 'r') as index_file:
+            index = json.load(index_file);
+        store.dtype = np.dtype(index['dtype']);
+        store.planes = index['planes'];
+        store.measurements = index.get('measurements', []);
+        return store;
+
+    def __len__(self):
+        return len(self.planes);
+
+    def writePlane(self, values, **metadata):
+        """
+        Appends the array values to the store, along with its metadata (which must be
+        JSON-serializable). Returns the index of the new plane.
+        """
+        shape = np.shape(values);
+        rows = np.reshape(values, (-1,) + shape[-1:]) if len(shape) > 1 else np.reshape(values, (1, -1));
+        rows_per_chunk = max(1, WRITE_CHUNK_BYTES // max(1, rows.shape[1]*self.dtype.itemsize));
+        with open(self.path, 'ab') as data_file:
+            offset = data_file.tell();
+            for start in range(0, rows.shape[0], rows_per_chunk):
+                np.ascontiguousarray(rows[start:start+rows_per_chunk], dtype=self.dtype).tofile(data_file);
+        entry = dict(metadata);
+        entry.update({'shape': list(shape), 'offset': offset});
+        self.planes.append(entry);
+        self.index_changed = True;
+        return len(self.planes) - 1;
+
+    def write(self, field, plane, stage):
+        """
+        Saves the current complex values of a field, as it reaches the mask or plane with
+        the identifier plane. stage is either 'pre_mask' or 'post_mask'.
+        Returns the index of the new plane, or None if we are only keeping measurements.
+        """
+        if(any(measure.appliesTo(plane) for measure in self.measures)):
+            with profiling.stage('measure', field=field.ident, plane=plane, stage=stage):
+                row = {'field': field.ident, 'plane': plane, 'stage': stage, 'z': float(field.z)};
+                row.update(measureField(field, self.measures, plane));
+                self.measurements.append(row);
+                self.index_changed = True;
+        if(not self.save_fields):
+            return None;
+        return self.writePlane(field.complex_values, field=field.ident, plane=plane, stage=stage,
+                z=float(field.z), wavelength=np.ravel(field.wavelengthSamples()).tolist(),
+                Lx=float(field.Lx), Ly=float(field.Ly));
+
+    def extend(self, other, **metadata):
+        """
+        Copies every plane (and measurement) of the store other into this store, adding
+        the extra metadata to each of them. The index is written once, at the end.
+        """
+        for (i, entry) in enumerate(other.planes):
+            combined = {key: value for (key, value) in entry.items() if key not in ('shape', 'offset')};
+            combined.update(metadata);
+            self.writePlane(other.load(i), **combined);
+        self.measurements += [dict(row, **metadata) for row in other.measurements];
+        self.index_changed = True;
+        self.flush();
+
+    def flush(self):
+        """
+        Writes the index, if anything has been added to the store since it was last written.
+        """
+        if(self.mode == 'w' and self.index_changed):
+            self.writeIndex();
+
+    def close(self):
+        self.flush();
+
+    def writeIndex(self):
+        index = {'dtype': self.dtype.str, 'planes': self.planes};
+        if(len(self.measurements) > 0):
+            index['measurements'] = self.measurements;
+        temporary_path = self.index_path + '.tmp';
+        with open(temporary_path, 'w') as index_file:
+            json.dump(index, index_file, indent=1);
+        os.replace(temporary_path, self.index_path);
+        self.index_changed = False;
+
+    def find(self, **criteria):
+        """
+        Returns the indices of every plane whose metadata matches all of the criteria,
+        e.g. store.find(field='G1', plane='P3', stage='pre_mask')
+        """
+        return [i for (i, entry) in enumerate(self.planes)
+                if all(entry.get(key) == value for (key, value) in criteria.items())];
+
+    def load(self, index):
+        """
+        Returns a read-only memory map of the plane with the given index.
+        """
+        entry = self.planes[index];
+        return np.memmap(self.path, dtype=self.dtype, mode='r',
+                offset=entry['offset'], shape=tuple(entry['shape']));
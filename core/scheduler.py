@@ -0,0 +1,189 @@
+# Parallel execution of independent simulations.
+#
+# Every source in a netlist is propagated through the masks independently of the others,
+# and so is every variant of a netlist in a parameter sweep (.step). Each of these is a
+# task which we can hand to a pool of worker processes. Workers parse the netlist text
+# themselves (the netlist functions can't be pickled), write their planes into their own
+# part of the result store, and the parts are gathered into the main store at the end.
+# Each worker process keeps its own transfer function and mask caches, which stay warm
+# across all the tasks it runs.
+
+import os
+from collections import OrderedDict
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from netlist.netlist_parser import NetlistParser
+from core.grid_planner import planGrid
+from core.result_store import ResultStore
+from core.simulation import prepareFields, checkSweep, simulateField
+from core.checkpoints import CheckpointCache, DEFAULT_LIMIT_BYTES, fileStamps, checkpointReport
+from plotting.render import HeadlessRenderer
+from core import profiling
+
+# The masks this process has parsed most recently, keyed by the netlist line (and any data
+# files) that defined them. Tasks for other sources of the same netlist, other variants of a
+# parameter sweep, and later jobs sent to the simulation server (core/server.py) reuse any
+# mask whose definition hasn't changed, along with its evaluated values, rather than
+# starting cold. The cache is limited both in the number of masks and in the total size of
+# their evaluated values, since on large grids a handful of masks can hold gigabytes.
+MAX_CACHED_MASKS = 64;
+MAX_CACHED_MASK_BYTES = 2*2**30;
+mask_cache = OrderedDict();
+
+def netlistVariants(text, directives):
+    """
+    Returns a list of (label, netlist text) for every variant of the netlist in the
+    parameter sweep (.step <element> <start> <stop> <N>), which replaces the first parameter
+    of the element (e.g. the focal length of a lens, or the diameter of an aperture) with
+    each value in turn. If there is no sweep, the netlist is the only variant.
+    """
+    if('step' not in directives):
+        return [('', text)];
+
+    (element, values) = directives['step'];
+    variants = [];
+    for value in values:
+        lines = [];
+        for line in text.splitlines():
+            chunks = line.split('#', 1)[0].replace(',', ' ').split();
+            if(len(chunks) > 2 and chunks[0] == element):
+                chunks[2] = f"{float(value)!r}mm";
+                line = ' '.join(chunks);
+            lines.append(line);
+        variants.append((f"_{element}={value:g}mm", '\n'.join(lines)));
+    return variants;
+
+def loadNetlist(text, label=''):
+    """
+    Parses the netlist text, swapping in the masks this process has already parsed for
+    any elements with the same definition. Returns (parser, masks, fields).
+    """
+    parser = NetlistParser(label, text=text);
+    with profiling.stage('parse', netlist=label):
+        [masks, fields] = parser.parseNetlist();
+    return (parser, [cachedMask(mask) for mask in masks], fields);
+
+def cachedMask(mask):
+    if(mask.definition == ''):
+        return mask;
+    key = (mask.definition, tuple(fileStamps(mask)));
+    if(key in mask_cache):
+        mask_cache.move_to_end(key);
+        return mask_cache[key];
+    mask_cache[key] = mask;
+    trimMaskCache();
+    return mask;
+
+def maskBytes(mask):
+    """
+    Returns the size of the evaluated values a mask is holding on to.
+    """
+    values = mask._value_cache.values() if mask._value_cache is not None else [];
+    return sum(value.nbytes for value in values);
+
+def maskCacheBytes():
+    return sum(maskBytes(mask) for mask in mask_cache.values());
+
+def trimMaskCache():
+    """
+    Evicts the least-recently used masks until the cache is within both of its limits. The
+    masks' values only grow once they are evaluated during a run, so this is also called
+    after each run by long-lived processes (core/server.py).
+    """
+    total = maskCacheBytes();
+    while(len(mask_cache) > MAX_CACHED_MASKS or (total > MAX_CACHED_MASK_BYTES and len(mask_cache) > 0)):
+        (_, mask) = mask_cache.popitem(last=False);
+        total -= maskBytes(mask);
+
+def runTask(task):
+    """
+    Simulates a single source of a single netlist variant, writing the results to
+    their own store. This runs in a worker process. Returns the location of the store,
+    the profiling events, and the task's checkpoint counts (skipped_steps, total_steps,
+    skipped_seconds), which are all zero without checkpoints.
+    """
+    (text, label, source_index, part_location, dtype, precision, output_directory,
+            checkpoint_directory, checkpoint_bytes, save_fields) = task;
+    first_event = len(profiling.active.events) if profiling.active is not None else 0;
+    (parser, masks, fields) = loadNetlist(text, label);
+    fields = prepareFields(fields, parser.directives, precision);
+    plan = planGrid(masks, fields, parser.directives);
+    store = ResultStore(part_location, dtype=dtype, measures=parser.directives.get('measure', []),
+            save_fields=save_fields);
+    checkpoints = None if checkpoint_directory is None else CheckpointCache(checkpoint_directory, checkpoint_bytes);
+    simulateField(fields[source_index], masks, plan, store, HeadlessRenderer(),
+            checkSweep(masks, parser.directives), output_directory, label, checkpoints);
+    store.close();
+    # Hand back what we profiled in this task, so it ends up in the trace of the main process
+    events = profiling.active.events[first_event:] if profiling.active is not None else [];
+    skipped = (0, 0, 0) if checkpoints is None else checkpoints.counts();
+    return (part_location, events, skipped);
+
+def runParallel(text, directives, number_sources, store, workers=1, precision=np.complex128,
+        checkpoint_directory=None, checkpoint_bytes=DEFAULT_LIMIT_BYTES, save_fields=True):
+    """
+    Runs every source of every variant of the netlist on a pool of workers processes,
+    and gathers the results into store. Each plane is labelled with its variant.
+    precision is the dtype the fields are simulated in. If checkpoint_directory is given,
+    every task resumes from (and adds to) the checkpoints in it. save_fields is False if
+    only the measurements (.measure) are kept.
+    Returns the list of variant labels.
+    """
+    output_directory = os.path.dirname(store.path);
+    variants = netlistVariants(text, directives);
+    tasks = [];
+    for (label, variant_text) in variants:
+        for source_index in range(number_sources):
+            part_location = f"{store.path}.part{len(tasks)}";
+            tasks.append((variant_text, label, source_index, part_location, store.dtype.str,
+                    np.dtype(precision).str, output_directory, checkpoint_directory, checkpoint_bytes,
+                    save_fields));
+    print(f"Running {len(tasks)} tasks ({len(variants)} variants x {number_sources} sources) on {workers} workers");
+
+    if(workers > 1):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(runTask, tasks));
+        if(profiling.active is not None):
+            for (part_location, events, skipped) in results:
+                profiling.active.merge(events);
+    else:
+        results = [runTask(task) for task in tasks];
+
+    for (task, (part_location, events, skipped)) in zip(tasks, results):
+        part = ResultStore.open(part_location);
+        store.extend(part, variant=task[1]);
+        os.remove(part.path);
+        os.remove(part.index_path);
+    if(checkpoint_directory is not None):
+        print(checkpointReport(*[sum(counts) for counts in zip(*[skipped for (_, _, skipped) in results])]));
+    return [label for (label, variant_text) in variants];
+
+def sumSources(store, mode, variant=None):
+    """
+    Sums the fields from every source at each plane, and adds the sums to the store as a
+    field called 'sum'. mode is 'coherent' (the complex fields are added) or 'incoherent'
+    (the intensities are added, and stored as the real part).
+    """
+    criteria = {} if variant is None else {'variant': variant};
+    indices = store.find(**criteria);
+    sources = sorted(set(store.planes[i]['field'] for i in indices));
+    keys = [];
+    for i in indices:
+        key = (store.planes[i]['plane'], store.planes[i]['stage']);
+        if(key not in keys):
+            keys.append(key);
+
+    for (plane, stage) in keys:
+        matches = store.find(plane=plane, stage=stage, **criteria);
+        entries = [store.planes[i] for i in matches];
+        if(len(matches) != len(sources) or len(set((entry['Lx'], entry['Ly']) for entry in entries)) > 1):
+            print(f"Not summing the sources at {plane} ({stage}), they are not all on the same grid");
+            continue;
+        total = 0;
+        for i in matches:
+            values = store.load(i);
+            total = total + (values if mode == 'coherent' else np.square(np.abs(values)));
+        metadata = dict(entries[0]);
+        del metadata['shape'], metadata['offset'];
+        metadata.update({'field': 'sum', 'quantity': 'field' if mode == 'coherent' else 'intensity'});
+        store.writePlane(total, **metadata);
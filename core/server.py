@@ -0,0 +1,278 @@
+# A long-lived simulation server, so that a stream of small jobs (e.g. design iterations
+# driven from a script) don't each pay for starting python, importing numpy and scipy,
+# and building transfer functions, FFT plans and mask values from scratch. Everything the
+# jobs have in common stays warm in the server between them.
+#
+#   $ python3 main.py --serve                   (on localhost:8765)
+#   $ python3 main.py --serve localhost:9000
+#   $ python3 main.py --serve /tmp/bde.sock     (on a Unix socket)
+#
+# The server speaks plain HTTP with JSON bodies:
+#   POST /jobs              {"netlist": "<netlist text>", "name": "<name>", "options": {...}}
+#                           queues a job and returns {"id": ..., "status": "queued"}. The options
+#                           are 'single', 'workers', 'sum', 'complex64', 'checkpoints' and 'fields',
+#                           as for main.py.
+#   GET  /jobs/<id>         the job's status ('queued', 'running', 'done' or 'failed'). Once it is
+#                           done, this includes the path of its result store, the store's index,
+#                           and any measurements.
+#   GET  /jobs/<id>?wait=1  the same, but waits for the job to finish first.
+#   GET  /stats             the number of jobs queued, and the state (and size in bytes) of the caches.
+# Any number of clients can submit jobs at once, and they are run in the order they arrive,
+# one at a time, on a single thread: the FFTs already use every core, and the caches are
+# shared between jobs and aren't thread-safe. The Client class below wraps all of this for
+# python, returning each job's result store.
+
+import http.client
+import http.server
+import json
+import os
+import queue
+import re
+import socket
+import socketserver
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from core.api import Simulation
+from core.result_store import ResultStore
+from core.transfer_functions import transfer_function_cache
+from core.checkpoints import DEFAULT_LIMIT_BYTES
+from core import scheduler
+
+DEFAULT_ADDRESS = 'localhost:8765';
+MAX_FINISHED_JOBS = 1000; # How many finished jobs we remember the status of
+
+def parseAddress(address):
+    """
+    Returns ('unix', path) for the path of a Unix socket, or ('tcp', (host, port)).
+    """
+    if('/' in address or address.endswith('.sock')):
+        return ('unix', address);
+    (host, _, port) = address.rpartition(':');
+    return ('tcp', (host or 'localhost', int(port)));
+
+class Job:
+    def __init__(self, identifier, text, name, options):
+        self.identifier = identifier;
+        self.text = text;
+        self.name = name;
+        self.options = options;
+        self.status = 'queued';
+        self.store_path = None;
+        self.error = None;
+        self.submitted = time.time();
+        self.seconds = None;
+        self.finished = threading.Event();
+
+    def report(self):
+        report = {'id': self.identifier, 'name': self.name, 'status': self.status};
+        if(self.status == 'done'):
+            store = ResultStore.open(self.store_path);
+            report.update({'store': self.store_path, 'seconds': self.seconds, 'planes': store.planes,
+                    'measurements': store.measurements});
+        elif(self.status == 'failed'):
+            report['error'] = self.error;
+        return report;
+
+class SimulationServer:
+    """
+    The job queue, and the thread that runs the jobs in it.
+    """
+    def __init__(self, output_directory, checkpoint_directory=None, checkpoint_bytes=DEFAULT_LIMIT_BYTES):
+        self.output_directory = output_directory;
+        self.checkpoint_directory = checkpoint_directory;
+        self.checkpoint_bytes = checkpoint_bytes;
+        self.jobs = OrderedDict();
+        self.queue = queue.Queue();
+        self.lock = threading.Lock();
+        self.next_identifier = 1;
+        self.completed = 0;
+        self.runner = threading.Thread(target=self.runJobs, daemon=True);
+        self.runner.start();
+
+    def submit(self, text, name='job', options={}):
+        # The name becomes part of a file name in the output directory, so it can't be a path
+        name = re.sub(r'[^\w.-]', '_', os.path.basename(str(name))).lstrip('.') or 'job';
+        with self.lock:
+            identifier = self.next_identifier;
+            self.next_identifier += 1;
+            job = Job(identifier, text, name, options);
+            self.jobs[identifier] = job;
+        self.queue.put(job);
+        return job;
+
+    def find(self, identifier):
+        with self.lock:
+            return self.jobs.get(identifier);
+
+    def runJobs(self):
+        while(True):
+            job = self.queue.get();
+            job.status = 'running';
+            started = time.perf_counter();
+            try:
+                self.run(job);
+                job.status = 'done';
+            except Exception:
+                job.error = traceback.format_exc();
+                job.status = 'failed';
+                print(f"Job {job.identifier} ({job.name}) failed:\n{job.error}");
+            job.seconds = time.perf_counter() - started;
+            job.finished.set();
+            with self.lock:
+                self.completed += 1;
+                self.forgetOldJobs();
+
+    def run(self, job):
+        options = job.options;
+        precision = np.complex64 if options.get('single') else np.complex128;
+        store_precision = np.complex64 if (options.get('complex64') or options.get('single')) else np.complex128;
+        simulation = Simulation(text=job.text, name=job.name, precision=precision);
+        print(simulation.plan.report());
+        output = os.path.join(self.output_directory, f"{job.name}_{job.identifier}.bde");
+        checkpoint_directory = self.checkpoint_directory if options.get('checkpoints') else None;
+        simulation.run(output, 'headless', int(options.get('workers', 1)), options.get('sum'), store_precision,
+                checkpoint_directory, self.checkpoint_bytes, True if options.get('fields') else None);
+        job.store_path = output;
+        scheduler.trimMaskCache();
+
+    def forgetOldJobs(self):
+        finished = [identifier for (identifier, job) in self.jobs.items() if job.finished.is_set()];
+        for identifier in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[identifier];
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'completed': self.completed,
+                'transfer_functions': transfer_function_cache.stats(),
+                'masks': {'size': len(scheduler.mask_cache), 'maxsize': scheduler.MAX_CACHED_MASKS,
+                        'bytes': scheduler.maskCacheBytes(), 'max_bytes': scheduler.MAX_CACHED_MASK_BYTES}};
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    server_version = 'BDE/1';
+
+    def do_POST(self):
+        if(urlparse(self.path).path != '/jobs'):
+            return self.reply(404, {'error': 'not found'});
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))));
+            text = request['netlist'];
+        except (ValueError, KeyError, TypeError):
+            return self.reply(400, {'error': "expected a JSON body with a 'netlist'"});
+        job = self.server.simulations.submit(text, request.get('name', 'job'), request.get('options', {}));
+        self.reply(202, {'id': job.identifier, 'status': job.status});
+
+    def do_GET(self):
+        url = urlparse(self.path);
+        parts = url.path.strip('/').split('/');
+        if(parts == ['stats']):
+            return self.reply(200, self.server.simulations.stats());
+        if(len(parts) != 2 or parts[0] != 'jobs' or not parts[1].isdigit()):
+            return self.reply(404, {'error': 'not found'});
+        job = self.server.simulations.find(int(parts[1]));
+        if(job is None):
+            return self.reply(404, {'error': f"no job {parts[1]}"});
+        if(parse_qs(url.query).get('wait', ['0'])[0] not in ('0', '')):
+            job.finished.wait();
+        self.reply(200, job.report());
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode();
+        self.send_response(status);
+        self.send_header('Content-Type', 'application/json');
+        self.send_header('Content-Length', str(len(data)));
+        self.end_headers();
+        self.wfile.write(data);
+
+    def address_string(self):
+        # Unix sockets don't have a client address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'local';
+
+class TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True;
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True;
+
+def serve(address=DEFAULT_ADDRESS, output_directory='./output', checkpoint_directory=None,
+        checkpoint_bytes=DEFAULT_LIMIT_BYTES):
+    """
+    Runs the simulation server on address until it is interrupted.
+    """
+    (kind, location) = parseAddress(address);
+    if(kind == 'unix'):
+        if(os.path.exists(location)):
+            os.remove(location); # Left over from a server that didn't shut down cleanly
+        http_server = UnixServer(location, RequestHandler);
+    else:
+        if(location[0] not in ('localhost', '127.0.0.1', '::1')):
+            print(f"WARNING: Serving on {location[0]}, which other machines may be able to reach");
+        http_server = TCPServer(location, RequestHandler);
+    http_server.simulations = SimulationServer(output_directory, checkpoint_directory, checkpoint_bytes);
+    print(f"Simulation server listening on {address}, writing results to {output_directory}");
+    try:
+        http_server.serve_forever();
+    except KeyboardInterrupt:
+        print("Shutting down the simulation server");
+    finally:
+        http_server.server_close();
+        if(kind == 'unix' and os.path.exists(location)):
+            os.remove(location);
+
+class UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout);
+        self.socket_path = path;
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM);
+        self.sock.connect(self.socket_path);
+
+class Client:
+    """
+    Submits jobs to a simulation server, e.g.
+        client = Client('localhost:8765');
+        store = client.run(open('netlist/my_netlist.txt').read(), name='my_netlist');
+    """
+    def __init__(self, address=DEFAULT_ADDRESS):
+        self.address = parseAddress(address);
+
+    def request(self, method, path, body=None):
+        (kind, location) = self.address;
+        connection = UnixConnection(location) if kind == 'unix' else http.client.HTTPConnection(*location);
+        try:
+            data = None if body is None else json.dumps(body).encode();
+            connection.request(method, path, body=data, headers={'Content-Type': 'application/json'});
+            response = connection.getresponse();
+            reply = json.loads(response.read());
+        finally:
+            connection.close();
+        if(response.status >= 400):
+            raise RuntimeError(reply.get('error', f"HTTP {response.status}"));
+        return reply;
+
+    def submit(self, text, name='job', **options):
+        """
+        Queues a netlist (given as text) on the server, returning the job's id.
+        """
+        return self.request('POST', '/jobs', {'netlist': text, 'name': name, 'options': options})['id'];
+
+    def status(self, identifier, wait=False):
+        return self.request('GET', f"/jobs/{identifier}" + ('?wait=1' if wait else ''));
+
+    def result(self, identifier):
+        """
+        Waits for a job to finish, and returns its result store.
+        """
+        report = self.status(identifier, wait=True);
+        if(report['status'] != 'done'):
+            raise RuntimeError(f"Job {identifier} failed:\n{report.get('error')}");
+        return ResultStore.open(report['store']);
+
+    def run(self, text, name='job', **options):
+        return self.result(self.submit(text, name, **options));
+
+    def stats(self):
+        return self.request('GET', '/stats');
@@ -0,0 +1,170 @@
+# The simulation loop itself: setting up the fields for a netlist, and propagating
+# each field through every mask and plane. This is used by main.py, and by the worker
+# processes when we run several sources or netlist variants in parallel.
+
+import os
+import time
+import numpy as np
+from core.fields import gridCoordinates
+from core.polychromatic import PolychromaticField
+from core.sweep import sweepVolume
+from core.beam_propagation import splitStepPropagate
+from core.checkpoints import replay
+from core import profiling
+
+def prepareFields(fields, directives, dtype=np.complex128):
+    """
+    Applies the simulation-wide directives to the fields returned by NetlistParser.
+    If the netlist asked for a polychromatic simulation (.poly), each source carries the
+    whole spectrum as a single (wavelength, y, x) stack, which is propagated in one go,
+    rather than creating a separate field for each wavelength.
+    dtype is the precision (np.complex128 or np.complex64) the fields are simulated in.
+    """
+    if('poly' in directives):
+        wavelengths = directives['poly'];
+        print(f"Polychromatic simulation with {wavelengths.size} wavelengths from {wavelengths[0]} to {wavelengths[-1]}")
+        fields = [PolychromaticField(field, wavelengths) for field in fields];
+    for field in fields:
+        field.dtype = np.dtype(dtype).type;
+    return fields;
+
+def checkSweep(masks, directives):
+    """
+    Returns the planes of the z-sweep (.sweep) if there is one, and None otherwise.
+    The intensity is computed on a whole volume of observation planes using a single
+    forward FFT, which is only valid if none of the masks actually do anything within
+    the swept range.
+    """
+    sweep_z = directives.get('sweep');
+    if(sweep_z is not None):
+        for mask in masks:
+            if(mask.z + mask.thickness > sweep_z[0] and mask.z <= sweep_z[-1] and not mask.is_passive_plane):
+                print(f"ERROR: Mask {mask.ident} at {mask.z}mm lies within the sweep, skipping the sweep.")
+                return None;
+    return sweep_z;
+
+def runSweep(field, sweep_z, output_directory, label=''):
+    filename = os.path.join(output_directory, field.ident + label + "_sweep.npy");
+    print(f"Sweeping {field.ident} over {sweep_z.size} planes from {sweep_z[0]}mm to {sweep_z[-1]}mm");
+    with profiling.stage('sweep', field=field.ident, planes=sweep_z.size):
+        sweepVolume(field, sweep_z, filename);
+    np.savetxt(os.path.join(output_directory, field.ident + label + "_sweep_z.txt"), sweep_z);
+
+def simulateField(field, masks, plan, store, renderer, sweep_z=None, output_directory='.', label='',
+        checkpoints=None):
+    """
+    Samples the source field on the grid chosen by plan, and then propagates it to each
+    plane and mask in turn, saving the field to the store before and after every mask.
+    With a CheckpointCache (core/checkpoints.py), the steps whose results are already in
+    the cache are skipped, and the results of the rest are added to it.
+    """
+    print(f"Beginning simulation with wavelength {field.wavelength}")
+    with profiling.stage('field', field=field.ident):
+        propagateField(field, masks, plan, store, renderer, sweep_z, output_directory, label, checkpoints);
+    store.flush();
+
+def propagateField(field, masks, plan, store, renderer, sweep_z, output_directory, label, checkpoints=None):
+    checkpoint = None; # The checkpoint of the current step, if we are writing one
+    saving_seconds = 0;
+    def save(plane, stage):
+        nonlocal saving_seconds
+        started = time.perf_counter();
+        saveAndPlot(field, plane, stage, store, renderer);
+        if(checkpoint is not None):
+            with profiling.stage('checkpoint', field=field.ident, plane=plane, stage=stage):
+                checkpoint.write(field, plane, stage);
+        saving_seconds += time.perf_counter() - started;
+
+    keys = {} if checkpoints is None else checkpoints.chainKeys(field, masks, plan);
+    (resumed, start) = ([], 0) if len(keys) == 0 else checkpoints.resume(masks, keys, sweep_z);
+    if(len(resumed) > 0):
+        print(f"Resuming {field.ident} from its checkpoint at {masks[start - 1].ident}, " +
+                f"skipping {len(resumed)} of {len(keys)} propagation steps");
+        replay(field, resumed, save);
+    else:
+        sampleSource(field, plan);
+
+    swept = (sweep_z is None);
+    for (i, mask) in enumerate(masks):
+        # Planes inside a thick element have already been saved on the way through it
+        if(i < start or mask.z < field.z):
+            continue;
+
+        # The sweep starts once the field has passed every mask before the first swept plane
+        if(not swept and mask.z > sweep_z[0]):
+            runSweep(field, sweep_z, output_directory, label);
+            swept = True;
+
+        if(i in keys):
+            checkpoint = checkpoints.begin(keys[i], field);
+        (started, saving_seconds) = (time.perf_counter(), 0);
+
+        # The field's values are only ever referred to by the field itself (the store and
+        # the renderers take copies), so they can be propagated in place.
+        delta_distance = mask.z - field.z;
+        print(f"Propagiting {delta_distance}mm")
+        OR = field.propagate(delta_distance, in_place=True);
+        save(mask.ident, 'pre_mask');
+        print(f"Oversampling Ratio: {OR}");
+        applyMask(field, mask, masks, plan, save);
+
+        if(checkpoint is not None):
+            checkpoints.commit(checkpoint, keys[i], time.perf_counter() - started - saving_seconds,
+                    [keys[j] for j in keys if j <= i]);
+            checkpoint = None;
+
+    if(not swept):
+        runSweep(field, sweep_z, output_directory, label);
+
+def sampleSource(field, plan):
+    """
+    Evaluates the source field on the grid chosen by plan.
+    """
+    x_coors = gridCoordinates(plan.size_x, plan.N_x);
+    y_coors = gridCoordinates(plan.size_y, plan.N_y);
+    (x_grid, y_grid) = np.meshgrid(x_coors, y_coors)
+    field.Lx = plan.size_x;
+    field.Ly = plan.size_y;
+    with profiling.stage('source', field=field.ident):
+        field.complex_values = np.ascontiguousarray(field.complexFunction(x_grid, y_grid,
+                field.wavelengthGrid()), dtype=field.dtype);
+
+def applyMask(field, mask, masks, plan, save):
+    """
+    Applies mask to field, which must already have been propagated to it, calling
+    save(plane, stage) for every plane that should be saved on the way.
+    """
+    # Thick elements are propagated through slice by slice, saving any planes inside them.
+    if(mask.thickness > 0):
+        inside = [other for other in masks if mask.z < other.z < mask.z + mask.thickness];
+        for other in inside:
+            if(not other.is_passive_plane):
+                print(f"ERROR: Mask {other.ident} lies inside thick element {mask.ident}, ignoring it.");
+        splitStepPropagate(field, mask, gridCoordinates(field.Lx, plan.N_x), gridCoordinates(field.Ly, plan.N_y),
+                [other for other in inside if other.is_passive_plane],
+                lambda plane: save(plane.ident, 'pre_mask'));
+        save(mask.ident, 'post_mask');
+        return;
+
+    # Then, evaluate the masks complex values for the given source (field). The far-field
+    # propagators change the pixel pitch of the field, in which case the mask has to be
+    # sampled on the field's new grid rather than the original one.
+    # Masks cache their values for each grid and wavelength, so we only pay for evaluating
+    # them the first time they are used with a particular grid/wavelength.
+    mask.Lx = field.Lx;
+    mask.Ly = field.Ly;
+    if(not mask.is_passive_plane):
+        mask.complex_values = mask.evaluate(gridCoordinates(field.Lx, plan.N_x),
+                gridCoordinates(field.Ly, plan.N_y), field.wavelengthGrid(), dtype=field.dtype);
+
+    # When appropriate, masks are applied to the field.
+    if(not mask.is_passive_plane):
+        with profiling.stage('apply_mask', field=field.ident, mask=mask.ident):
+            field.complex_values *= mask.complex_values;
+        save(mask.ident, 'post_mask');
+
+def saveAndPlot(field, plane, stage, store, renderer):
+    with profiling.stage('save', field=field.ident, plane=plane, stage=stage):
+        store.write(field, plane, stage);
+    with profiling.stage('plot', field=field.ident, plane=plane, stage=stage):
+        renderer.submit(field, plane, stage);
@@ -0,0 +1,66 @@
+# Volumetric z-sweeps.
+#
+# If all we want is the intensity at a whole series of observation planes, with no
+# masks in between them, then we don't need to propagate from plane to plane. Every
+# plane is just H(z)*U1, where U1 is the spectrum of the field at the start of the sweep,
+# so we only need a single forward FFT. The planes are then computed a chunk at a time
+# with one batched inverse FFT per chunk, and their intensities are written straight into
+# a memory-mapped .npy file, so the complex volume never has to be in memory at once.
+# Single-precision fields are swept in single precision, and give a float32 volume.
+
+import numpy as np
+from core.fourier import fft2, ifft2
+from core.transfer_functions import fresnelTransferFunction
+
+# Rough upper bound on the memory used by the complex planes of a single chunk.
+SWEEP_CHUNK_BYTES = 256*2**20;
+
+def sweepVolume(field, z_values, filename, chunk_size=None):
+    """
+    Computes the intensity of the field at every location in z_values, and writes them
+    to the .npy file filename as a (z, y, x) volume. The locations are absolute
+    positions along the optical axis, and must all be at or after the field's location.
+    Polychromatic fields are summed incoherently over their spectrum.
+    As in the propagators, the field is centered on [M//2, N//2], and we can skip the
+    fftshifts since they cancel out around the circular convolution with H.
+    Returns the memory-mapped volume.
+    """
+    z_values = np.asarray(z_values, dtype=float);
+    distances = z_values - field.z;
+    if(np.any(distances < 0)):
+        raise ValueError(f"Cannot sweep field {field.ident} at z={field.z} backwards to z={z_values.min()}");
+
+    dtype = field.complex_values.dtype;
+    field_shape = field.complex_values.shape[-2:];
+    (M, N) = field_shape;
+    dx = field.Lx/N;
+    dy = field.Ly/M;
+
+    if(chunk_size is None):
+        chunk_size = max(1, SWEEP_CHUNK_BYTES // (dtype.itemsize*field.complex_values.size));
+
+    # The one and only forward FFT.
+    U1 = fft2(field.complex_values);
+
+    # The Fresnel transfer function only depends on the product of the wavelength and the
+    # distance, so a stack of distances can be built exactly like a stack of wavelengths.
+    wavelengths = np.atleast_1d(field.wavelengthSamples());
+    weights = getattr(field, 'weights', None);
+
+    volume = np.lib.format.open_memmap(filename, mode='w+', dtype=field.complex_values.real.dtype,
+            shape=(z_values.size,) + field_shape);
+    for start in range(0, z_values.size, chunk_size):
+        stop = min(start + chunk_size, z_values.size);
+        products = np.multiply.outer(distances[start:stop], wavelengths); # (chunk, wavelength)
+        if(weights is None):
+            products = products[:, 0];
+        H = fresnelTransferFunction(field_shape, dx, dy, products, 1.0, dtype);
+        H *= U1;
+        planes = ifft2(H, overwrite=True);
+        intensity = np.square(np.abs(planes));
+        if(weights is not None): # Incoherent sum over the spectrum
+            intensity = np.tensordot(intensity, weights, axes=([1], [0]));
+        volume[start:stop] = intensity;
+        volume.flush();
+
+    return volume;
@@ -0,0 +1,128 @@
+# Transfer functions for the Fourier-domain propagators, along with a cache so that
+# we don't recompute them every time we propagate a field.
+#
+# In a typical simulation every field is propagated on the same grid and at the same
+# wavelength, and very often by the same distances (e.g. from one plane to the next).
+# Building the Fresnel transfer function requires a complex exponential over the whole
+# grid, which costs about as much as the FFTs themselves, so it is well worth keeping
+# the ones we have already built around.
+#
+# The phase of a transfer function can run to thousands of radians at the edge of the grid,
+# and a float32 phase of that size is only good to about 1e-4 radians, so the phases are
+# always computed in double precision. For single-precision simulations, the 1D factors
+# are then rounded to complex64 before forming their outer product, which keeps the error
+# of H at the float32 rounding level (~1e-7) without ever building a double-precision H.
+
+from collections import OrderedDict
+import numpy as np
+from core import profiling
+
+def fresnelTransferFunction(shape, dx, dy, wavelength, distance, dtype=np.complex128):
+    """
+    Returns the Fresnel transfer function H(fx, fy) = exp(-i pi lambda z (fx^2 + fy^2))
+    sampled on the frequency grid of a field with the given shape and pixel pitch.
+    The result is in FFT order (zero frequency at index [0, 0]), so it can multiply
+    the output of fft2 directly without any fftshift.
+
+    wavelength may also be a 1D array of wavelengths, in which case a (wavelength, y, x)
+    stack of transfer functions is returned, one for each wavelength.
+
+    Because H is separable in fx and fy, we only evaluate the complex exponential on
+    two 1D frequency vectors and then form their outer product (in dtype).
+    """
+    (Hy, Hx) = fresnelFactors(shape, dx, dy, wavelength, distance, dtype);
+    return Hy[..., :, None]*Hx[..., None, :];
+
+def fresnelFactors(shape, dx, dy, wavelength, distance, dtype=np.complex128):
+    """
+    Returns the 1D factors (Hy, Hx) of the Fresnel transfer function, such that
+    H = Hy[:, None]*Hx[None, :] (with a leading wavelength axis on both, for a spectrum).
+    """
+    (M, N) = shape;
+    fx = np.fft.fftfreq(N, dx);
+    fy = np.fft.fftfreq(M, dy);
+    wavelength = np.asarray(wavelength, dtype=float);
+    Hx = np.exp(-1j*np.pi*distance*np.multiply.outer(wavelength, np.square(fx))).astype(dtype);
+    Hy = np.exp(-1j*np.pi*distance*np.multiply.outer(wavelength, np.square(fy))).astype(dtype);
+    return (Hy, Hx);
+
+def impulseResponseTransferFunction(shape, dx, dy, wavelength, distance, dtype=np.complex128):
+    """
+    Returns the transfer function of the impulse-response Fresnel propagator: the FFT of
+    the sampled Fresnel impulse response h(x, y) = exp(i pi (x^2 + y^2) / (lambda z)) / (i lambda z),
+    in FFT order. Unlike the analytic transfer function, this stays well-sampled at long
+    distances (when lambda z > L dx), which is where we use it.
+
+    h is separable too, so we only need two 1D FFTs rather than a 2D one.
+    """
+    (Hy, Hx) = impulseResponseFactors(shape, dx, dy, wavelength, distance, dtype);
+    return Hy[..., :, None]*Hx[..., None, :];
+
+def impulseResponseFactors(shape, dx, dy, wavelength, distance, dtype=np.complex128):
+    """
+    Returns the 1D factors (Hy, Hx) of the impulse-response transfer function, with
+    the constant dx*dy/(i lambda z) included in Hy.
+    """
+    (M, N) = shape;
+    x = (np.arange(N) - N//2) * dx;
+    y = (np.arange(M) - M//2) * dy;
+    wavelength = np.asarray(wavelength, dtype=float);
+    lz = wavelength * distance;
+    hx = np.exp(1j*np.pi*np.multiply.outer(1/lz, np.square(x)));
+    hy = np.exp(1j*np.pi*np.multiply.outer(1/lz, np.square(y)));
+    Hx = np.fft.fft(np.fft.ifftshift(hx, axes=-1), axis=-1);
+    Hy = np.fft.fft(np.fft.ifftshift(hy, axes=-1), axis=-1);
+    Hy = (Hy * np.asarray(dx*dy/(1j*lz))[..., None]).astype(dtype);
+    return (Hy, Hx.astype(dtype));
+
+class TransferFunctionCache:
+    """
+    A bounded least-recently-used cache of transfer functions, keyed by the
+    grid shape, pixel pitch, wavelength (or wavelengths), propagation distance and dtype.
+    """
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize;
+        self.hits = 0;
+        self.misses = 0;
+        self._entries = OrderedDict();
+
+    def get(self, shape, dx, dy, wavelength, distance, builder=fresnelTransferFunction, dtype=np.complex128):
+        """
+        Returns the transfer function for the given parameters, building it with
+        builder(shape, dx, dy, wavelength, distance, dtype) if it is not already cached.
+        dtype is complex128 or complex64.
+        The returned array is read-only, since it is shared between callers.
+        """
+        dtype = np.dtype(dtype);
+        wavelength_key = tuple(np.ravel(wavelength).tolist()); # Allow for a whole spectrum
+        key = (builder.__name__, tuple(shape), float(dx), float(dy), wavelength_key, float(distance), dtype.str);
+        if(key in self._entries):
+            self.hits += 1;
+            profiling.count('transfer_function_hits');
+            self._entries.move_to_end(key);
+            return self._entries[key];
+
+        self.misses += 1;
+        profiling.count('transfer_function_misses');
+        H = builder(shape, dx, dy, wavelength, distance, dtype);
+        H.setflags(write=False);
+        self._entries[key] = H;
+        if(len(self._entries) > self.maxsize):
+            self._entries.popitem(last=False); # Evict the least-recently used entry
+        return H;
+
+    def clear(self):
+        self._entries.clear();
+        self.hits = 0;
+        self.misses = 0;
+
+    def stats(self):
+        """
+        Returns a dictionary with the hit/miss counters and current size of the cache.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._entries), 'maxsize': self.maxsize,
+                'bytes': sum(H.nbytes for H in self._entries.values())};
+
+# The cache shared by all fields in this process.
+transfer_function_cache = TransferFunctionCache();
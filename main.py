@@ -4,8 +4,7 @@
 #
 # TODO:
 # 1. Add sampling / aliasing checks
-# 2. Add capability to add photos / non-analytic phase functions to netlist
-# 3. 
+# 2. 
 #
 # CONTEXT, APPLICATIONS
 # This is a Fourier-Optics based physical optics simulator. Its main purpose is to calculate
@@ -63,7 +62,7 @@
 #   These objects just contain the complex amplitude value you are applying to the 
 #   electromagnetic field as it propagates through that plane. Masks are fundamentally 
 #   two-dimensional. Any three-dimensional objects are sliced up into a bunch of 2D masks 
-#   separated by some distance (which the simulator handles). These masks can be defined as sources or
+#   separated by some distance (which the simulator handles, see core/beam_propagation.py). These masks can be defined as sources or
 #   'passive' elements, (lenses apertures, stops, etc.). You may have multiple sources at various locations
 #   in your simulation. The results will be saved separately and optionally summed.
 #   Field objects are created from sources, and mask objects are created from everything else.
@@ -89,74 +88,105 @@
 #   the utilities I have written to load in the results of your simulation and plot them, be my guest.
 
 import numpy as np
+import argparse
+import os
 import sys
-from core.fields import *
-from netlist.netlist_parser import *
-import matplotlib.pyplot as plt
+from core.transfer_functions import transfer_function_cache
+from core.api import Simulation
+from core import profiling
 
 # 1. The class NetlistParser parses a netlist and turns everything into a "Mask" or "Field" object.
 # The masks and field are returned so that they are sorted in ascending order with
 # respect to their coordinate on the optical axis.
-arguments = len(sys.argv) - 1; # The number of arguments
-netlist_location = './netlist/sample_netlist.txt';
-print(arguments);
-print(sys.argv);
-if(arguments > 0):
-    print(f"Using user defined netlist {sys.argv[1]}")
-    netlist_location = sys.argv[1];
-print("Parsing netlist... ");
-parser = NetlistParser(netlist_location);
-[masks, fields] = parser.parseNetlist();
-print("Parsing complete !");
-
-# Now, using all the masks and fields, figure out what our simulation size needs to be,
-# and how much we need to discretize it. For now, we will just arbitrarily choose
-# a simulation size. We want to generate mesh grids for the x coordinates and y
-# coordinates so that numpy can efficiently calculate quantities given a numpy array.
-# We should define all magnitude and phase functions so that they are purely numpy
-# functions to ensure efficient evaluation and a total lack of looping.
-size_x = 500;
-size_y = 500;
-N_x = 200;
-N_y = 200;
-x_coors = np.linspace(-size_x/2, size_x/2, N_x);
-y_coors = np.linspace(-size_y/2, size_y/2, N_y);
-(x_grid, y_grid) = np.meshgrid(x_coors, y_coors)
-
+# Everything after parsing the arguments is done through the Simulation API (core/api.py),
+# which can also be used directly from python, or through the simulation server (--serve).
+argument_parser = argparse.ArgumentParser(description="Berkeley Diffraction Engine");
+argument_parser.add_argument('netlist', nargs='?', default='./netlist/sample_netlist.txt',
+        help="The netlist to simulate");
+argument_parser.add_argument('--output', default=None,
+        help="Result store to write (default: ./output/<netlist name>.bde), or with --serve, " +
+        "the directory to write the result stores of the jobs into (default: ./output)");
+argument_parser.add_argument('--complex64', action='store_true',
+        help="Store the results in single precision, halving their size on disk");
+argument_parser.add_argument('--single', action='store_true',
+        help="Simulate (and store) the fields in single precision, halving the memory used");
+render_options = argument_parser.add_mutually_exclusive_group();
+render_options.add_argument('--headless', dest='render', action='store_const', const='headless',
+        help="Don't plot anything");
+render_options.add_argument('--png', dest='render', action='store_const', const='png',
+        help="Render plots to PNG files in the output folder, in the background");
+argument_parser.add_argument('--workers', type=int, default=1,
+        help="Number of processes used to run independent sources and .step variants");
+argument_parser.add_argument('--sum', choices=['coherent', 'incoherent'], default=None,
+        help="Sum the fields (coherent) or intensities (incoherent) of all the sources at each plane");
+argument_parser.add_argument('--out-of-core', action='store_true',
+        help="Keep the fields in memory-mapped files rather than in memory, for grids larger than RAM");
+argument_parser.add_argument('--checkpoints', nargs='?', const='', default=None, metavar='DIRECTORY',
+        help="Save the field after every element, and resume from the last unchanged one when re-run " +
+        "(in DIRECTORY, or output/checkpoints by default)");
+argument_parser.add_argument('--checkpoint-limit', type=float, default=4,
+        help="Maximum size of the checkpoints in GiB, removing the least-recently used beyond it");
+argument_parser.add_argument('--fields', action='store_true',
+        help="Save (and plot) the fields even when the netlist only asks for measurements (.measure)");
+argument_parser.add_argument('--serve', nargs='?', const='', default=None, metavar='ADDRESS',
+        help="Run a simulation server on ADDRESS (host:port, or the path of a Unix socket; " +
+        "localhost:8765 by default), keeping the caches warm between jobs");
+argument_parser.add_argument('--profile', action='store_true',
+        help="Profile each stage of the simulation (also enabled by BDE_PROFILE=1)");
+arguments = argument_parser.parse_args();
+if(arguments.profile):
+    os.environ['BDE_PROFILE'] = '1'; # So that any worker processes profile themselves too
+    profiling.enable();
+precision = np.complex64 if arguments.single else np.complex128;
+store_precision = np.complex64 if (arguments.complex64 or arguments.single) else np.complex128;
+checkpoint_bytes = int(arguments.checkpoint_limit * 2**30);
 
-# 3. That 'Field' object is then propagated to each plane and Mask
-print("Beginning simulation...");
-for field in fields:
-    print(f"Beginning simulation with wavelength {field.wavelength}")
-    field.Lx = size_x;
-    field.Ly = size_y;
-    field.complex_values = np.zeros((N_y, N_x));
-    field.complex_values = field.complexFunction(x_grid, y_grid, field.wavelength);
+if(arguments.serve is not None):
+    # Rather than running a netlist, wait for jobs (see core/server.py)
+    from core.server import serve, DEFAULT_ADDRESS
+    checkpoint_directory = arguments.checkpoints;
+    if(checkpoint_directory == ''):
+        checkpoint_directory = os.path.join('.', 'output', 'checkpoints');
+    serve(arguments.serve or DEFAULT_ADDRESS, arguments.output or os.path.join('.', 'output'),
+            checkpoint_directory, checkpoint_bytes);
+    sys.exit(0);
 
-    for mask in masks:
-        # First, evaluate the masks complex values for the given source (field)
-        mask.Lx = size_x;
-        mask.Ly = size_y;
-
-        # If the mask is not just a plane
-        if(mask.complexFunction(np.zeros((1,1)),np.zeros((1,1)),field.wavelength) != None):
-            mask.complex_values = np.zeros((N_y, N_x));
-            mask.complex_values = mask.complexFunction(x_grid, y_grid, field.wavelength);
+netlist_location = arguments.netlist;
+print(f"Using netlist {netlist_location}")
+print("Parsing netlist... ");
+simulation = Simulation(netlist_location, precision=precision, out_of_core=arguments.out_of_core);
+print("Parsing complete !");
+print(simulation.plan.report());
 
-        delta_distance = mask.z - field.z;
-        print(f"Propagiting {delta_distance}mm")
-        OR = field.fresnelPropagate(delta_distance);
-        field.saveValues("./output/" + field.ident + "_" + mask.ident + "_" + "pre_mask.txt");
-        field.plotMagPhase(mask.ident + ' Before Mask');
-        print(f"Oversampling Ratio: {OR}");
+# Every plane we save during the simulation goes into a single binary result store,
+# which can be loaded (lazily) with plotting/load_results.py
+store_location = arguments.output;
+if(store_location is None):
+    store_location = os.path.join('.', 'output', simulation.name + '.bde');
+checkpoint_directory = arguments.checkpoints;
+if(checkpoint_directory == ''):
+    checkpoint_directory = os.path.join(os.path.dirname(store_location) or '.', 'checkpoints');
 
-        # 3a. When appropriate, masks are applied to the field.
-        if(mask.complexFunction(np.zeros((1,1)),np.zeros((1,1)),field.wavelength) != None):
-            field.complex_values = field.complex_values*mask.complex_values;
-            field.saveValues("./output/" + field.ident + "_" + mask.ident + "_" + "post_mask.txt");
-            field.plotMagPhase(mask.ident + 'After Mask');
+# 2./3. The 'Field' objects are then propagated to each plane and Mask
+store = simulation.run(store_location, arguments.render, arguments.workers, arguments.sum, store_precision,
+        checkpoint_directory, checkpoint_bytes, True if arguments.fields else None);
 
-plt.show();
+# The transfer function cache should be getting hits whenever fields share a grid,
+# wavelength and propagation distance.
+cache_stats = transfer_function_cache.stats();
+print(f"Transfer function cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses");
+mask_hits = sum(mask.cache_hits for mask in simulation.masks);
+mask_misses = sum(mask.cache_misses for mask in simulation.masks);
+print(f"Mask evaluation cache: {mask_hits} hits, {mask_misses} misses");
 
 # 4. When the Field reaches the final plane or mask, the simulation is terminated.
+print(f"Saved {len(store)} planes to {store_location}");
+
+# If we were profiling, report where the time went, and save a trace that can be opened
+# in chrome://tracing or Perfetto.
+if(profiling.active is not None):
+    print(profiling.active.summary());
+    trace_location = os.path.splitext(store_location)[0] + '_trace.json';
+    profiling.active.writeChromeTrace(trace_location);
+    print(f"Saved profiling trace to {trace_location}");
 print("Simulation Complete!");
@@ -16,12 +16,19 @@ APERTURE_HEIGHT = 3;
 import re
 import numpy as np
 from core.fields import * # import our core objects that will be sent back to our program.
+from core.beam_propagation import ThickElement
+from core.diffuser import Diffuser, DEFAULT_PHASE_STD
+from core.image_mask import ImageMask, MASK_KINDS, INTERPOLATIONS
+from core.measurements import Measure, OBSERVABLES
 
 class NetlistParser:
     filename = '';
+    directives = {}; # Simulation-wide settings from lines starting with a '.'
 
-    def __init__(self, filename):
+    def __init__(self, filename, text=None):
         self.filename = filename;
+        self.text = text; # If given, the netlist is parsed from this text instead of the file
+        self.directives = {};
 
     # Stripts the units after the number
     def stripUnits(self, text):
@@ -37,9 +44,12 @@ class NetlistParser:
     def parseNetlist(self):
         fields = []; # 
         masks = [];
-        f = open(self.filename, 'r');
+        if(self.text is None):
+            f = open(self.filename, 'r');
+            f1 = f.readlines();
+        else:
+            f1 = self.text.splitlines();
         sep = '#'; # The separator for our netlist files. Also comment symbol.
-        f1 = f.readlines();
         processed_lines = [];
         for line in f1:
             comments_removed = line.split(sep, 1)[0];   # Removes all comments
@@ -53,6 +63,14 @@ class NetlistParser:
         for line in processed_lines:
             line_chunks = line.split(' ');
             name = line_chunks[0];
+
+            # Lines starting with a '.' are directives, which control the simulation as
+            # a whole rather than defining an element, so they have no location.
+            if(line[0] == '.'):
+                self.parseDirective(line_chunks);
+                continue;
+
+            (number_masks, number_fields) = (len(masks), len(fields));
             location_text = line_chunks[1];
             location = self.stripUnits(location_text);
 
@@ -80,19 +98,21 @@ class NetlistParser:
                 waist = self.stripUnits(line_chunks[GAUSSIAN_WAIST_POSITION]);
 
                 phase_function = lambda x, y, l: np.zeros(x.shape);
-                intensity_function = lambda x, y, l: 1* np.exp(-(np.square(x)+np.square(y))/np.square(waist));
+                intensity_function = lambda x, y, l, waist=waist: 1* np.exp(-(np.square(x)+np.square(y))/np.square(waist));
 
                 new_gaussian_beam = Field(name, location, wavelength, phase_function, intensity_function);
+                new_gaussian_beam.parameters = {'waist': waist};
                 fields.append(new_gaussian_beam);
 
             elif(line[0] == 'L'): # Thin lens - note that the phase mask actually depends on the wavelength.
 
                 focal_length = self.stripUnits(line_chunks[2]);
 
-                phase_function = lambda x, y, l: 2*np.pi / (2*focal_length * l) * (np.square(x) + np.square(y));
+                phase_function = lambda x, y, l, focal_length=focal_length: 2*np.pi / (2*focal_length * l) * (np.square(x) + np.square(y));
                 amplitude_function = lambda x, y, l: np.ones(x.shape);
 
                 new_lens = Mask(name, location, phase_function, amplitude_function);
+                new_lens.parameters = {'focal_length': focal_length};
                 masks.append(new_lens);
 
             elif(line[0] == 'P'): # The line contains a plane definition
@@ -102,9 +122,11 @@ class NetlistParser:
             elif(line[0] == 'C'): # Circular aperture 
                 diameter = self.stripUnits(line_chunks[APERTURE_WIDTH]);
 
-                amplitude_function = lambda x, y, l: circ(diameter, x, y);
+                amplitude_function = lambda x, y, l, diameter=diameter: circ(diameter, x, y);
                 phase_function = lambda x, y, l: np.zeros(x.shape);
                 new_aperture = Mask(name, location, phase_function, amplitude_function);
+                new_aperture.parameters = {'width': diameter, 'height': diameter};
+                new_aperture.wavelength_independent = True;
                 masks.append(new_aperture);
 
             elif(line[0] == 'R'): # Rectangular aperture
@@ -112,29 +134,172 @@ class NetlistParser:
                 width = self.stripUnits(line_chunks[APERTURE_WIDTH]);
                 height = self.stripUnits(line_chunks[APERTURE_HEIGHT]);
 
-                amplitude_function = lambda x, y, l: rect(width, height, x, y);
+                amplitude_function = lambda x, y, l, width=width, height=height: rect(width, height, x, y);
                 phase_function = lambda x, y, l: np.zeros(x.shape);
                 new_aperture = Mask(name, location, phase_function, amplitude_function);
+                new_aperture.parameters = {'width': width, 'height': height};
+                new_aperture.wavelength_independent = True;
+                new_aperture.separableAmplitude = (lambda x, width=width: step(width, x),
+                        lambda y, height=height: step(height, y));
                 masks.append(new_aperture);
 
             elif(line[0] == 'S'): # Square aperture
 
                 width = self.stripUnits(line_chunks[APERTURE_WIDTH]);
 
-                amplitude_function = lambda x, y, l: sq(width, x, y);
+                amplitude_function = lambda x, y, l, width=width: sq(width, x, y);
                 phase_function = lambda x, y, l: np.zeros(x.shape);
                 new_aperture = Mask(name, location, phase_function, amplitude_function);
+                new_aperture.parameters = {'width': width, 'height': width};
+                new_aperture.wavelength_independent = True;
+                new_aperture.separableAmplitude = (lambda x, width=width: step(width, x),
+                        lambda y, width=width: step(width, y));
 
                 masks.append(new_aperture);
 
+            elif(line[0] == 'T'): # Thick element, propagated through with the split-step method
+                new_element = self.parseThickElement(name, location, line_chunks[2:]);
+                if(new_element is not None):
+                    masks.append(new_element);
+
+            elif(line[0] == 'D'): # Random phase diffuser: D<name> <location> <correlation_length> [<phase_std>] [seed=<n>]
+                correlation_length = self.stripUnits(line_chunks[2]);
+                options = dict(chunk.split('=', 1) for chunk in line_chunks[3:] if '=' in chunk);
+                values = [chunk for chunk in line_chunks[3:] if '=' not in chunk];
+                phase_std = float(values[0]) if len(values) > 0 else DEFAULT_PHASE_STD;
+                seed = int(options['seed']) if 'seed' in options else None;
+                masks.append(Diffuser(name, location, correlation_length, phase_std, seed));
+
+            elif(line[0] == 'I'): # Mask from an image or .npy file: I<name> <location> <file> <width> <height> [<kind>] [interp=<mode>]
+                new_mask = self.parseImageMask(name, location, line_chunks[2:]);
+                if(new_mask is not None):
+                    masks.append(new_mask);
 
             else:
                 print("ERROR: Not able to parse line:")
                 print(line)
                 print("Object type not supported");
 
+            # Remember the line each element came from, which identifies it for checkpointing
+            for element in masks[number_masks:] + fields[number_fields:]:
+                element.definition = line;
+
         masks = sorted(masks, key=lambda x: x.z);
         fields = sorted(fields, key=lambda x: x.z);
 
         return [masks, fields];
 
+    def parseThickElement(self, name, location, chunks):
+        """
+        Parses the parameters of a thick element, e.g. 'cylinder 2mm 1.5 dz=10um n0=1.33'.
+        Returns None (after printing an error) if the element can't be parsed.
+        """
+        options = dict(chunk.split('=', 1) for chunk in chunks if '=' in chunk);
+        values = [chunk for chunk in chunks if '=' not in chunk];
+        shape = values[0].lower() if len(values) > 0 else '';
+        slice_spacing = self.stripUnits(options['dz']) if 'dz' in options else None;
+        background_index = float(options.get('n0', 1.0));
+        volume = None;
+
+        if(shape in ('cylinder', 'sphere') and len(values) == 3): # <diameter> <index>
+            diameter = self.stripUnits(values[1]);
+            (width, height, thickness) = (diameter, diameter, diameter);
+            index = float(values[2]);
+        elif(shape == 'block' and len(values) == 5): # <width> <height> <thickness> <index>
+            (width, height, thickness) = [self.stripUnits(value) for value in values[1:4]];
+            index = float(values[4]);
+        elif(shape == 'file' and len(values) == 5): # <path.npy> <width> <height> <thickness>
+            try:
+                volume = np.load(values[1], mmap_mode='r');
+            except (OSError, ValueError) as error:
+                print(f"ERROR: Not able to load thick element {name}: {error}");
+                return None;
+            (width, height, thickness) = [self.stripUnits(value) for value in values[2:5]];
+            index = None;
+        else:
+            print("ERROR: Not able to parse thick element:")
+            print(' '.join([name] + chunks))
+            return None;
+
+        new_element = ThickElement(name, location, shape, width, height, thickness, index,
+                background_index, slice_spacing, volume);
+        if(volume is not None):
+            new_element.files = (values[1],);
+        if(shape == 'cylinder'): # The cylinder is infinitely long in y
+            new_element.parameters = {'width': width, 'height': width, 'thickness': thickness};
+        return new_element;
+
+    def parseImageMask(self, name, location, chunks):
+        """
+        Parses the parameters of a mask loaded from a file, e.g. 'masks/logo.png 5mm 5mm phase
+        interp=nearest'. Returns None (after printing an error) if the mask can't be parsed
+        or its file can't be loaded.
+        """
+        options = dict(chunk.split('=', 1) for chunk in chunks if '=' in chunk);
+        values = [chunk for chunk in chunks if '=' not in chunk];
+        kind = values[3].lower() if len(values) > 3 else None;
+        interpolation = options.get('interp', 'linear').lower();
+        if(len(values) not in (3, 4) or (kind is not None and kind not in MASK_KINDS) or
+                interpolation not in INTERPOLATIONS):
+            print("ERROR: Not able to parse image mask:")
+            print(' '.join([name] + chunks))
+            return None;
+        width = self.stripUnits(values[1]);
+        height = self.stripUnits(values[2]);
+        try:
+            return ImageMask(name, location, values[0], width, height, kind, interpolation);
+        except (OSError, ValueError) as error:
+            print(f"ERROR: Not able to load image mask {name}: {error}");
+            return None;
+
+    def parseDirective(self, line_chunks):
+        """
+        Parses a directive line (e.g. '.poly 400nm 700nm 50') into self.directives
+        """
+        directive = line_chunks[0].lower();
+
+        if(directive == '.poly'): # Polychromatic simulation: .poly <start> <stop> <N>
+            start = self.stripUnits(line_chunks[1]);
+            stop = self.stripUnits(line_chunks[2]);
+            number_wavelengths = int(line_chunks[3]);
+            self.directives['poly'] = np.linspace(start, stop, number_wavelengths);
+
+        elif(directive == '.sweep'): # Volumetric z-sweep: .sweep <z_start> <z_stop> <N>
+            z_start = self.stripUnits(line_chunks[1]);
+            z_stop = self.stripUnits(line_chunks[2]);
+            number_planes = int(line_chunks[3]);
+            self.directives['sweep'] = np.linspace(z_start, z_stop, number_planes);
+
+        elif(directive == '.grid'): # Explicit simulation grid: .grid <size> <N>
+            size = self.stripUnits(line_chunks[1]);
+            number_points = int(line_chunks[2]);
+            self.directives['grid'] = (size, number_points);
+
+        elif(directive == '.step'): # Parameter sweep: .step <element> <start> <stop> <N>
+            element = line_chunks[1];
+            start = self.stripUnits(line_chunks[2]);
+            stop = self.stripUnits(line_chunks[3]);
+            number_steps = int(line_chunks[4]);
+            self.directives['step'] = (element, np.linspace(start, stop, number_steps));
+
+        elif(directive == '.measure'): # Observable: .measure <name> <observable> [<parameter>] [at=<element>]
+            planes = [chunk[3:] for chunk in line_chunks[3:] if chunk.startswith('at=')];
+            values = [chunk for chunk in line_chunks[3:] if not chunk.startswith('at=')];
+            observable = line_chunks[2].lower() if len(line_chunks) > 2 else '';
+            if(observable not in OBSERVABLES or len(values) != int(OBSERVABLES[observable][0])):
+                print("ERROR: Not able to parse measurement:")
+                print(' '.join(line_chunks))
+                return;
+            parameter = self.stripUnits(values[0]) if len(values) > 0 else None;
+            self.directives.setdefault('measure', []).append(Measure(line_chunks[1], observable, parameter,
+                    planes if len(planes) > 0 else None));
+
+        elif(directive == '.ensemble'): # Ensemble of random realizations: .ensemble <N> [batch]
+            number_realizations = int(line_chunks[1]);
+            batch_size = int(line_chunks[2]) if len(line_chunks) > 2 else None;
+            self.directives['ensemble'] = (number_realizations, batch_size);
+
+        else:
+            print("ERROR: Not able to parse directive:")
+            print(' '.join(line_chunks))
+            print("Directive not supported");
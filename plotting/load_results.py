@@ -0,0 +1,48 @@
+# Utilities for loading in the results of a simulation, as written to a result store by main.py
+# Nothing is read from disk until you ask for a particular plane, and then only that plane
+# is memory-mapped, so this is fast even for very large runs.
+#
+# Example:
+#   from plotting.load_results import loadResults, loadPlane
+#   results = loadResults('output/sample_netlist.bde')
+#   P3 = loadPlane(results, field='W1', plane='P3', stage='pre_mask')
+
+import numpy as np
+from core.result_store import ResultStore
+
+def loadResults(path):
+    """
+    Opens the result store at path without loading any of its planes.
+    """
+    return ResultStore.open(path);
+
+def listPlanes(results):
+    """
+    Prints out a summary of every plane in the results.
+    """
+    for (i, entry) in enumerate(results.planes):
+        print(f"{i}: {entry['field']} at {entry['plane']} ({entry['stage']}), z={entry['z']}mm, " +
+                f"Lx={entry['Lx']}mm, Ly={entry['Ly']}mm, shape {tuple(entry['shape'])}");
+
+def loadPlane(results, **criteria):
+    """
+    Returns a memory map of the first plane matching the criteria (e.g. field='W1', plane='P3'),
+    along with its metadata.
+    """
+    matches = results.find(**criteria);
+    if(len(matches) == 0):
+        raise KeyError(f"No plane matching {criteria}");
+    return (results.load(matches[0]), results.planes[matches[0]]);
+
+def plotPlane(results, **criteria):
+    """
+    Plots the magnitude and phase of the first plane matching the criteria. Incoherent
+    sums, which hold an intensity, are plotted as the magnitude with that intensity.
+    """
+    from plotting.plotting import plotMagPhase
+    (values, entry) = loadPlane(results, **criteria);
+    if(entry.get('quantity') == 'intensity'):
+        values = np.sqrt(np.abs(values));
+    if(values.ndim > 2): # Polychromatic planes are summed over the spectrum
+        values = np.sqrt(np.sum(np.square(np.abs(values)), axis=0));
+    plotMagPhase(values, Lmax=entry['Lx']);
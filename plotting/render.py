@@ -0,0 +1,145 @@
+# Rendering of the fields during a simulation, decoupled from the simulation loop itself.
+#
+# There are three ways to render:
+#   inline:   The original behaviour. Each snapshot is plotted with matplotlib as soon as it
+#             is taken, and all the figures are shown at the end of the simulation.
+#   headless: Nothing is plotted at all, and matplotlib is never imported.
+#   png:      Snapshots are handed off to a background worker process, which downsamples them
+#             to display resolution and writes them out as PNG files. The simulation never waits
+#             on matplotlib (unless it gets more than MAX_PENDING snapshots ahead of the worker).
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+DISPLAY_SIZE = 512; # Resolution (in pixels) of the rendered images
+MAX_PENDING = 8; # Maximum number of snapshots waiting to be rendered
+
+class InlineRenderer:
+    plotted = False;
+
+    def submit(self, field, plane, stage):
+        title = plane + (' Before Mask' if stage == 'pre_mask' else ' After Mask');
+        field.plotMagPhase(title);
+        self.plotted = True;
+
+    def finish(self):
+        if(self.plotted):
+            import matplotlib.pyplot as plt
+            plt.show();
+
+class HeadlessRenderer:
+    def submit(self, field, plane, stage):
+        pass;
+
+    def finish(self):
+        pass;
+
+class PNGRenderer:
+    """
+    Renders snapshots of the field to PNG files in output_directory, in a background process.
+    """
+    def __init__(self, output_directory, display_size=DISPLAY_SIZE):
+        self.output_directory = output_directory;
+        self.display_size = display_size;
+        self.pending = deque();
+        self.executor = ProcessPoolExecutor(max_workers=1);
+        os.makedirs(output_directory, exist_ok=True);
+
+    def submit(self, field, plane, stage):
+        # We only take every n'th sample here, so that the copy we hand to the worker is
+        # small and the field can carry on being modified. The worker does the rest of the
+        # downsampling by averaging.
+        values = field.complex_values;
+        stride = max(1, min(values.shape[-2:]) // (2*self.display_size));
+        snapshot = np.array(values[..., ::stride, ::stride]);
+        filename = os.path.join(self.output_directory, f"{field.ident}_{plane}_{stage}.png");
+        title = f"{field.ident} at {plane} ({stage.replace('_', ' ')})";
+
+        while(len(self.pending) >= MAX_PENDING):
+            self.pending.popleft().result();
+        self.pending.append(self.executor.submit(renderSnapshot, snapshot, field.Lx, field.Ly,
+                filename, title, self.display_size));
+
+    def finish(self):
+        while(len(self.pending) > 0):
+            self.pending.popleft().result();
+        self.executor.shutdown(wait=True);
+
+def makeRenderer(mode, output_directory='./output'):
+    if(mode == 'headless'):
+        return HeadlessRenderer();
+    elif(mode == 'png'):
+        return PNGRenderer(output_directory);
+    else:
+        return InlineRenderer();
+
+def renderStore(store, renderer):
+    """
+    Renders every plane in a result store, for fields which were simulated out of the
+    renderer's sight (in the worker processes of a parallel run). The planes of each
+    .step variant are labelled with it. Incoherent sums hold an intensity rather than a
+    field, so they are rendered as the (real) field with that intensity.
+    """
+    from core.fields import Field
+    from core.polychromatic import PolychromaticField
+    for (i, entry) in enumerate(store.planes):
+        wavelengths = entry['wavelength'];
+        snapshot = Field(entry['field'] + entry.get('variant', ''), entry['z'], wavelengths[0], None, None);
+        if(len(wavelengths) > 1):
+            snapshot = PolychromaticField(snapshot, wavelengths);
+        values = store.load(i);
+        if(entry.get('quantity') == 'intensity'):
+            values = np.sqrt(np.abs(values));
+        snapshot.complex_values = values;
+        (snapshot.Lx, snapshot.Ly) = (entry['Lx'], entry['Ly']);
+        renderer.submit(snapshot, entry['plane'], entry['stage']);
+
+def downsample(image, display_size):
+    """
+    Block-averages a 2D image so that neither side is larger than display_size.
+    """
+    factor = int(np.ceil(max(image.shape) / display_size));
+    if(factor <= 1):
+        return image;
+    (M, N) = (image.shape[0] // factor * factor, image.shape[1] // factor * factor);
+    return image[:M, :N].reshape(M//factor, factor, N//factor, factor).mean(axis=(1, 3));
+
+def renderSnapshot(values, Lx, Ly, filename, title, display_size):
+    """
+    Writes the intensity and phase of values to the PNG file filename. Polychromatic
+    snapshots (a stack of wavelengths) only have their total intensity plotted.
+    This runs in the worker process, and only uses the object-oriented matplotlib API
+    so that it never needs a display.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    intensity = np.square(np.abs(values));
+    if(intensity.ndim > 2):
+        intensity = intensity.sum(axis=0);
+    intensity = downsample(intensity, display_size);
+    extent = [-Lx/2, Lx/2, -Ly/2, Ly/2] if (Lx != 0 and Ly != 0) else None;
+
+    if(values.ndim > 2):
+        figure = Figure(figsize=(7, 7));
+        axes = [figure.add_subplot(1, 1, 1)];
+    else:
+        figure = Figure(figsize=(14, 7));
+        axes = [figure.add_subplot(1, 2, 1), figure.add_subplot(1, 2, 2)];
+    FigureCanvasAgg(figure);
+
+    image = axes[0].imshow(intensity, extent=extent);
+    axes[0].set_title('Intensity');
+    figure.colorbar(image, ax=axes[0]);
+    if(len(axes) > 1):
+        stride = max(1, int(np.ceil(max(values.shape) / display_size)));
+        image = axes[1].imshow(np.angle(values[::stride, ::stride]), extent=extent);
+        axes[1].set_title('Phase');
+        figure.colorbar(image, ax=axes[1]);
+    for ax in axes:
+        ax.set_xlabel('x(mm)');
+        ax.set_ylabel('y(mm)');
+    figure.suptitle(title);
+    figure.savefig(filename);